@@ -0,0 +1,52 @@
+import argparse
+import subprocess
+import sys
+import time
+
+
+def timed(cmd, repeats):
+    """ Best wall time of ``cmd`` over ``repeats`` fresh interpreters. """
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def import_offenders(code, top):
+    """ Modules with the largest cumulative import time under ``-X importtime``. """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = [x.strip() for x in line[len('import time:'):].split('|')]
+        rows.append((int(cumulative_us), int(self_us), name))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-algo', "--algorithm", type=str, default="FedAvg")
+    parser.add_argument('-r', "--repeats", type=int, default=5)
+    parser.add_argument('-top', "--top", type=int, default=15)
+    args = parser.parse_args()
+
+    server_code = "from flcore.registry import get_server; get_server({!r})".format(args.algorithm)
+    cases = [
+        ('main.py --help', [sys.executable, 'main.py', '--help']),
+        ('import {}'.format(args.algorithm), [sys.executable, '-c', server_code]),
+    ]
+
+    print("{:<30}{:>12}".format('case', 'best (s)'))
+    for label, cmd in cases:
+        print("{:<30}{:>12.3f}".format(label, timed(cmd, args.repeats)))
+
+    for label, code in [('main.py --help', "import sys; sys.argv = ['main.py']; import main; main.get_parser()"),
+                        ('import {}'.format(args.algorithm), server_code)]:
+        print("\nslowest imports for {} (cumulative us, self us, module):".format(label))
+        for cumulative_us, self_us, name in import_offenders(code, args.top):
+            print("{:>12}{:>12}  {}".format(cumulative_us, self_us, name))
@@ -1,22 +1,35 @@
 import numpy as np
 import time
 from flcore.clients.clientbase import Client
-from utils.data_utils import read_client_data
 from utils.ALA import ALA
 
 
 class clientALA(Client):
-    def __init__(self, args, id, train_samples, test_samples, **kwargs):
-        super().__init__(args, id, train_samples, test_samples, **kwargs)
+    def __init__(self, args, id, train_data, test_data, train_samples, test_samples, **kwargs):
+        super().__init__(args, id, train_data, test_data, train_samples, test_samples, **kwargs)
 
         self.eta = args.eta
         self.rand_percent = args.rand_percent
         self.layer_idx = args.layer_idx
 
-        train_data = read_client_data(self.dataset, self.id, is_train=True)
-        self.ALA = ALA(self.id, self.loss, train_data, self.batch_size, 
+        self.ALA = ALA(self.id, self.loss, self.train_data, self.batch_size, 
                     self.rand_percent, self.layer_idx, self.eta, self.device)
 
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state['ala'] = {'weights': self.ALA.weights, 'start_phase': self.ALA.start_phase}
+        return state
+
+    def load_checkpoint_state(self, state):
+        super().load_checkpoint_state(state)
+        weights = state['ala']['weights']
+        self.ALA.weights = None if weights is None else [w.to(self.device) for w in weights]
+        self.ALA.start_phase = state['ala']['start_phase']
+
+    def next_task(self, train, test, label_info=None, if_label=True):
+        super().next_task(train, test, label_info, if_label)
+        self.ALA.set_train_data(self.train_data)
+
     def train(self):
         trainloader = self.load_train_data()
         # self.model.to(self.device)
@@ -35,8 +48,7 @@ class clientALA(Client):
                 else:
                     x = x.to(self.device)
                 y = y.to(self.device)
-                if self.train_slow:
-                    time.sleep(0.1 * np.abs(np.random.rand()))
+                self.train_time_cost['num_samples'] += len(y)
                 output = self.model(x)
                 loss = self.loss(output, y)
                 self.optimizer.zero_grad()
@@ -52,5 +64,5 @@ class clientALA(Client):
         self.train_time_cost['total_cost'] += time.time() - start_time
         
 
-    def local_initialization(self, received_global_model):
-        self.ALA.adaptive_local_aggregation(received_global_model, self.model)
\ No newline at end of file
+    def local_initialization(self, received_global_model, seed=None):
+        self.ALA.adaptive_local_aggregation(received_global_model, self.model, seed)
\ No newline at end of file
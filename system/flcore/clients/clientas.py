@@ -5,17 +5,21 @@ import numpy as np
 import time
 import copy
 from flcore.clients.clientbase import Client
-from torch.autograd import grad
+from flcore.utils.fisher_utils import FisherTraceEstimator
 
 
 
 
 class clientAS(Client):
+    checkpoint_attrs = Client.checkpoint_attrs + ['fim_trace_history']
 
-
-    def __init__(self, args, id, train_samples, test_samples, **kwargs):
-        super().__init__(args, id, train_samples, test_samples, **kwargs)
+    def __init__(self, args, id, train_data, test_data, train_samples, test_samples, **kwargs):
+        super().__init__(args, id, train_data, test_data, train_samples, test_samples, **kwargs)
         self.fim_trace_history = []
+        self.fisher = FisherTraceEstimator(args.fim_estimator, args.fim_batches, args.fim_probes)
+
+    def checkpoint_fingerprint(self):
+        return super().checkpoint_fingerprint() + (len(self.fim_trace_history),)
 
     def train(self, is_selected):
         if is_selected:
@@ -37,8 +41,7 @@ class clientAS(Client):
                     else:
                         x = x.to(self.device)
                     y = y.to(self.device)
-                    if self.train_slow:
-                        time.sleep(0.1 * np.abs(np.random.rand()))
+                    self.train_time_cost['num_samples'] += len(y)
                     output = self.model(x)
                     loss = self.loss(output, y)
                     self.optimizer.zero_grad()
@@ -53,63 +56,12 @@ class clientAS(Client):
             self.train_time_cost['num_rounds'] += 1
             self.train_time_cost['total_cost'] += time.time() - start_time
 
+        # Compute the FIM trace after training. Clients whose weights did not
+        # change since the last estimate (e.g. not selected) reuse it.
+        fim_trace = self.fisher.estimate(self.id, self.model, self.load_train_data(), self.device)
 
-            # set model to eval mode
-            self.model.eval()
-            # print(f'client{self.id}, start cal fim.')
-            # Compute FIM and its trace after training
-            fim_trace_sum = 0
-            for i, (x, y) in enumerate(self.load_train_data()):
-                # Forward pass
-                x = x.to(self.device)
-                y = y.to(self.device)
-                outputs = self.model(x)
-                # Negative log likelihood as our loss
-                nll = -torch.nn.functional.log_softmax(outputs, dim=1)[range(len(y)), y].mean()
-
-                # Compute gradient of the negative log likelihood w.r.t. model parameters
-                grads = grad(nll, self.model.parameters())
-
-                # Compute and accumulate the trace of the Fisher Information Matrix
-                for g in grads:
-                    fim_trace_sum += torch.sum(g ** 2).detach()
-
-            # add the fisher log
-            self.fim_trace_history.append(fim_trace_sum.item())
-
-            # Evaluate on the client's test dataset
-            # test_acc = self.evaluate()
-            # print(f"Client {self.id}, Test Accuracy: {test_acc:.1f}, FIM-T value: {fim_trace_sum.item():.1f}")
-            # print(f"Selected: {is_selected}, FIM-T value change: {(self.fim_trace_history[-1] - (self.fim_trace_history[-2] if len(self.fim_trace_history) > 1 else 0)):.1f}")
-
-        else:
-            trainloader = self.load_train_data()
-            # self.model.to(self.device)
-            self.model.eval()
-            # Compute FIM and its trace after training
-            fim_trace_sum = 0
-            for i, (x, y) in enumerate(trainloader):
-                # Forward pass
-                x = x.to(self.device)
-                y = y.to(self.device)
-                outputs = self.model(x)
-                # Negative log likelihood as our loss
-                nll = -torch.nn.functional.log_softmax(outputs, dim=1)[range(len(y)), y].mean()
-
-                # Compute gradient of the negative log likelihood w.r.t. model parameters
-                grads = grad(nll, self.model.parameters())
-
-                # Compute and accumulate the trace of the Fisher Information Matrix
-                for g in grads:
-                    fim_trace_sum += torch.sum(g ** 2).detach()
-
-            # add the fisher log
-            self.fim_trace_history.append(fim_trace_sum.item())
-
-            # Evaluate on the client's test dataset
-            # test_acc = self.evaluate()
-            # print(f"Client {self.id}, Test Accuracy: {test_acc:.1f}, FIM-T value: {fim_trace_sum.item():.1f}")
-            # print(f"FIM-T value change: {(self.fim_trace_history[-1] - (self.fim_trace_history[-2] if len(self.fim_trace_history) > 1 else 0)):.1f}")
+        # add the fisher log
+        self.fim_trace_history.append(fim_trace)
 
     def evaluate(self):
         testloader = self.load_test_data()
@@ -133,53 +85,24 @@ class clientAS(Client):
         #     old_param.data = new_param.data.clone()
 
     def set_parameters(self, model, progress):
+        # align a copy: the received model is shared (the server's global model,
+        # or the client's downlink copy that later deltas are applied to)
+        model = copy.deepcopy(model)
 
         # Get class-specific prototypes from the local model
-        local_prototypes = [[] for _ in range(self.num_classes)]
         batch_size = 16  # or any other suitable value
         trainloader = self.load_train_data(batch_size=batch_size)
-
-        # print(f'client{id}')
-        for x_batch, y_batch in trainloader:
-            x_batch = x_batch.to(self.device)
-            y_batch = y_batch.to(self.device)
-
-            with torch.no_grad():
-                proto_batch = self.model.base(x_batch)
-
-            # Scatter the prototypes based on their labels
-            for proto, y in zip(proto_batch, y_batch):
-                local_prototypes[y.item()].append(proto)
-
-        mean_prototypes = []
-
-        # print(f'client{self.id}')
-        for class_prototypes in local_prototypes:
-
-            if not class_prototypes == []:
-                # Stack the tensors for the current class
-                stacked_protos = torch.stack(class_prototypes)
-
-                # Compute the mean tensor for the current class
-                mean_proto = torch.mean(stacked_protos, dim=0)
-                mean_prototypes.append(mean_proto)
-            else:
-                mean_prototypes.append(None)
+        mean_prototypes, has_prototype = self.compute_prototypes(trainloader)
 
         # Align global model's prototype with the local prototype
         alignment_optimizer = torch.optim.SGD(model.base.parameters(), lr=0.01)  # Adjust learning rate and optimizer as needed
-        alignment_loss_fn = torch.nn.MSELoss()
 
-        # print(f'client{self.id}')
         for _ in range(1):  # Iterate for 1 epochs; adjust as needed
             for x_batch, y_batch in trainloader:
                 x_batch = x_batch.to(self.device)
                 y_batch = y_batch.to(self.device)
                 global_proto_batch = model.base(x_batch)
-                loss = 0
-                for label in y_batch.unique():
-                    if mean_prototypes[label.item()] is not None:
-                        loss += alignment_loss_fn(global_proto_batch[y_batch == label], mean_prototypes[label.item()])
+                loss = self.prototype_alignment_loss(global_proto_batch, y_batch, mean_prototypes, has_prototype)
                 alignment_optimizer.zero_grad()
                 loss.backward()
                 alignment_optimizer.step()
@@ -191,3 +114,39 @@ class clientAS(Client):
 
         # end
 
+    def compute_prototypes(self, trainloader):
+        """
+        Class means of the local representations, accumulated with index_add_
+        into a (num_classes, D) buffer in one pass over the data.
+        """
+        proto_sum = None
+        counts = torch.zeros(self.num_classes, device=self.device)
+        with torch.no_grad():
+            for x_batch, y_batch in trainloader:
+                x_batch = x_batch.to(self.device)
+                y_batch = y_batch.to(self.device)
+                proto_batch = self.model.base(x_batch).flatten(1)
+                if proto_sum is None:
+                    proto_sum = torch.zeros(self.num_classes, proto_batch.size(1), device=self.device)
+                proto_sum.index_add_(0, y_batch, proto_batch)
+                counts.index_add_(0, y_batch, torch.ones_like(y_batch, dtype=counts.dtype))
+
+        has_prototype = counts > 0
+        if proto_sum is None:
+            return None, has_prototype
+        return proto_sum / counts.clamp(min=1).unsqueeze(1), has_prototype
+
+    def prototype_alignment_loss(self, global_proto_batch, y_batch, mean_prototypes, has_prototype):
+        """
+        Sum over the classes of the batch of the MSE between their global
+        representations and the local prototype, computed without a per-class loop.
+        """
+        if mean_prototypes is None:
+            return global_proto_batch.sum() * 0.
+        global_proto_batch = global_proto_batch.flatten(1)
+        sq_err = (global_proto_batch - mean_prototypes[y_batch]).pow(2).sum(dim=1)
+        class_err = torch.zeros(self.num_classes, device=sq_err.device, dtype=sq_err.dtype).index_add_(0, y_batch, sq_err)
+        class_cnt = torch.bincount(y_batch, minlength=self.num_classes).to(sq_err.dtype)
+        valid = has_prototype & (class_cnt > 0)
+        per_class = class_err / (class_cnt.clamp(min=1) * global_proto_batch.size(1))
+        return (per_class * valid).sum()
@@ -27,8 +27,7 @@ class clientAVG(Client):
                 else:
                     x = x.to(self.device)
                 y = y.to(self.device)
-                if self.train_slow:
-                    time.sleep(0.1 * np.abs(np.random.rand()))
+                self.train_time_cost['num_samples'] += len(y)
                 output = self.model(x)
                 loss = self.loss(output, y)
                 self.optimizer.zero_grad()
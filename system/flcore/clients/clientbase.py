@@ -4,14 +4,18 @@ import torch.nn as nn
 import numpy as np
 import os
 from torch.utils.data import DataLoader
-from sklearn.preprocessing import label_binarize
-from sklearn import metrics
+from torch.nn.utils import vector_to_parameters
+from flcore.utils.fisher_utils import model_checksum
 
 
 class Client(object):
     """
     Base class for clients in federated learning.
     """
+    # plain attributes saved with checkpoint_state
+    checkpoint_attrs = ['current_task', 'task_dict', 'classes_so_far', 'current_labels', 'classes_past_task',
+                        'available_labels_current', 'available_labels_past', 'available_labels',
+                        'if_last_copy', 'train_time_cost', 'send_time_cost']
 
     def __init__(self, args, id, train_data, test_data, train_samples, test_samples, **kwargs):
         torch.manual_seed(0)
@@ -48,8 +52,13 @@ class Client(object):
 
         self.train_slow = kwargs['train_slow']
         self.send_slow = kwargs['send_slow']
-        self.train_time_cost = {'num_rounds': 0, 'total_cost': 0.0}
-        self.send_time_cost = {'num_rounds': 0, 'total_cost': 0.0}
+        # sim_cost: simulated training + upload time, charged by the server (Server.charge_round)
+        self.train_time_cost = {'num_rounds': 0, 'total_cost': 0.0, 'num_samples': 0, 'sim_cost': 0.0}
+        self.send_time_cost = {'num_rounds': 0, 'total_cost': 0.0, 'total_bytes': 0}
+
+        # copy of the global model rebuilt from downlink broadcasts
+        self.received_flat = None
+        self.received_model = None
 
         self.loss = nn.CrossEntropyLoss()
         self.optimizer = torch.optim.SGD(self.model.parameters(), lr=self.learning_rate)
@@ -137,6 +146,54 @@ class Client(object):
         for new_param, old_param in zip(model.parameters(), self.model.parameters()):
             old_param.data = new_param.data.clone()
 
+    def checkpoint_fingerprint(self):
+        """ Changes whenever checkpoint_state would; unchanged clients are not rewritten.
+
+        The weights are compared by content: most setters write them through
+        ``.data``, which the autograd version counter does not see.
+        """
+        return (model_checksum(self.model), self.current_task,
+                self.train_time_cost['num_rounds'], self.send_time_cost['num_rounds'])
+
+    def checkpoint_state(self):
+        return {
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.learning_rate_scheduler.state_dict(),
+            'last_copy': None if self.last_copy is None else self.last_copy.state_dict(),
+            'attrs': {name: getattr(self, name) for name in self.checkpoint_attrs},
+        }
+
+    def load_checkpoint_state(self, state):
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.learning_rate_scheduler.load_state_dict(state['scheduler'])
+        if state['last_copy'] is None:
+            self.last_copy = None
+        else:
+            self.last_copy = copy.deepcopy(self.model)
+            self.last_copy.load_state_dict(state['last_copy'])
+        for name, value in state['attrs'].items():
+            setattr(self, name, value)
+
+    def receive_broadcast(self, kind, payload, codec):
+        """ Apply a downlink message to the client's copy of the global model and return that copy.
+
+        The returned model aliases ``received_flat``, the base of the next delta,
+        so callers must not modify it in place.
+        """
+        if kind == 'full':
+            if self.received_flat is None:
+                self.received_flat = payload['values'].detach().clone()
+                self.received_model = copy.deepcopy(self.model)
+                # the parameters of received_model are views into received_flat
+                vector_to_parameters(self.received_flat, self.received_model.parameters())
+            else:
+                self.received_flat.copy_(payload['values'])
+        elif kind == 'delta':
+            codec.decode_into(payload, self.received_flat)
+        return self.received_model
+
     def clone_model(self, model, target):
         for param, target_param in zip(model.parameters(), target.parameters()):
             target_param.data = param.data.clone()
@@ -146,7 +203,33 @@ class Client(object):
         for param, new_param in zip(model.parameters(), new_params):
             param.data = new_param.data.clone()
 
+    def estimate_loss(self, model=None, max_batches=1):
+        """ Mean training loss of ``model`` (default: the local model) over at most ``max_batches`` batches. """
+        model = self.model if model is None else model
+        was_training = model.training
+        model.eval()
+
+        losses = 0.
+        num = 0
+        with torch.no_grad():
+            for i, (x, y) in enumerate(self.train_loader):
+                if max_batches > 0 and i >= max_batches:
+                    break
+                if type(x) == type([]):
+                    x[0] = x[0].to(self.device)
+                else:
+                    x = x.to(self.device)
+                y = y.to(self.device)
+                losses += self.loss(model(x), y).item() * y.shape[0]
+                num += y.shape[0]
+
+        model.train(was_training)
+        return losses / num if num > 0 else 0.
+
     def test_metrics(self):
+        from sklearn.preprocessing import label_binarize
+        from sklearn import metrics
+
         testloaderfull = self.load_test_data()
         # self.model = self.load_model('model')
         # self.model.to(self.device)
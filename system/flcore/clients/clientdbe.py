@@ -3,35 +3,32 @@ import torch.nn as nn
 import numpy as np
 import time
 from flcore.clients.clientbase import Client
-from sklearn.preprocessing import label_binarize
-from sklearn import metrics
-from torch.autograd import Variable
+from utils.DBE import DBE
 
 
 class clientDBE(Client):
-    def __init__(self, args, id, train_samples, test_samples, **kwargs):
-        super().__init__(args, id, train_samples, test_samples, **kwargs)
+    def __init__(self, args, id, train_data, test_data, train_samples, test_samples, **kwargs):
+        super().__init__(args, id, train_data, test_data, train_samples, test_samples, **kwargs)
 
         self.klw = args.kl_weight
         self.momentum = args.momentum
-        self.global_mean = None
+        self.warmup_batches = args.dbe_warmup_batches
 
-        trainloader = self.load_train_data()        
-        for x, y in trainloader:
-            if type(x) == type([]):
-                x[0] = x[0].to(self.device)
-            else:
-                x = x.to(self.device)
-            y = y.to(self.device)
-            with torch.no_grad():
-                rep = self.model.base(x).detach()
-            break
-        self.running_mean = torch.zeros_like(rep[0])
-        self.num_batches_tracked = torch.tensor(0, dtype=torch.long, device=self.device)
+        self.dbe = DBE(DBE.feature_shape(self.model), self.momentum, self.klw).to(self.device)
+        # own optimizer, so learning_rate_scheduler leaves the client mean's rate constant
+        self.opt_client_mean = torch.optim.SGD([self.dbe.client_mean], lr=self.learning_rate)
 
-        self.client_mean = nn.Parameter(Variable(torch.zeros_like(rep[0])))
-        self.opt_client_mean = torch.optim.SGD([self.client_mean], lr=self.learning_rate)
 
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state['dbe'] = self.dbe.state_dict()
+        state['opt_client_mean'] = self.opt_client_mean.state_dict()
+        return state
+
+    def load_checkpoint_state(self, state):
+        super().load_checkpoint_state(state)
+        self.dbe.load_state_dict(state['dbe'])
+        self.opt_client_mean.load_state_dict(state['opt_client_mean'])
 
     def train(self):
         trainloader = self.load_train_data()
@@ -44,7 +41,7 @@ class clientDBE(Client):
         if self.train_slow:
             max_local_epochs = np.random.randint(1, max_local_epochs // 2)
 
-        self.reset_running_stats()
+        self.dbe.reset_running_stats()
         for epoch in range(max_local_epochs):
             for i, (x, y) in enumerate(trainloader):
                 if type(x) == type([]):
@@ -52,26 +49,14 @@ class clientDBE(Client):
                 else:
                     x = x.to(self.device)
                 y = y.to(self.device)
-                if self.train_slow:
-                    time.sleep(0.1 * np.abs(np.random.rand()))
+                self.train_time_cost['num_samples'] += len(y)
                     
                 # ====== begin
-                rep = self.model.base(x)
-                running_mean = torch.mean(rep, dim=0)
-
-                if self.num_batches_tracked is not None:
-                    self.num_batches_tracked.add_(1)
-
-                self.running_mean = (1-self.momentum) * self.running_mean + self.momentum * running_mean
-                
-                if self.global_mean is not None:
-                    reg_loss = torch.mean(0.5 * (self.running_mean - self.global_mean)**2)
-                    output = self.model.head(rep + self.client_mean)
-                    loss = self.loss(output, y)
-                    loss = loss + reg_loss * self.klw
-                else:
-                    output = self.model.head(rep)
-                    loss = self.loss(output, y)
+                rep, reg_loss = self.dbe(self.model.base(x))
+                output = self.model.head(rep)
+                loss = self.loss(output, y)
+                if reg_loss is not None:
+                    loss = loss + reg_loss
                 # ====== end
 
                 self.opt_client_mean.zero_grad()
@@ -79,7 +64,6 @@ class clientDBE(Client):
                 loss.backward()
                 self.optimizer.step()
                 self.opt_client_mean.step()
-                self.detach_running()
 
         # self.model.cpu()
 
@@ -90,12 +74,12 @@ class clientDBE(Client):
         self.train_time_cost['total_cost'] += time.time() - start_time
 
 
-    def reset_running_stats(self):
-        self.running_mean.zero_()
-        self.num_batches_tracked.zero_()
-
-    def detach_running(self):
-        self.running_mean.detach_()
+    def warmup(self):
+        # initialization period: only the running mean is needed, no training;
+        # eval mode keeps BatchNorm running statistics untouched
+        self.model.eval()
+        self.dbe.collect_running_mean(self.model.base, self.load_train_data(), self.device, self.warmup_batches)
+        self.model.train()
 
     def train_metrics(self):
         trainloader = self.load_train_data()
@@ -111,7 +95,7 @@ class clientDBE(Client):
                     x = x.to(self.device)
                 y = y.to(self.device)
                 rep = self.model.base(x)
-                output = self.model.head(rep + self.client_mean)
+                output = self.model.head(rep + self.dbe.client_mean)
                 loss = self.loss(output, y)
                 train_num += y.shape[0]
                 losses += loss.item() * y.shape[0]
@@ -119,6 +103,9 @@ class clientDBE(Client):
         return losses, train_num
 
     def test_metrics(self):
+        from sklearn.preprocessing import label_binarize
+        from sklearn import metrics
+
         testloaderfull = self.load_test_data()
         self.model.eval()
 
@@ -126,8 +113,7 @@ class clientDBE(Client):
         test_num = 0
         y_prob = []
         y_true = []
-        reps = []
-        
+
         with torch.no_grad():
             for x, y in testloaderfull:
                 if type(x) == type([]):
@@ -136,7 +122,7 @@ class clientDBE(Client):
                     x = x.to(self.device)
                 y = y.to(self.device)
                 rep = self.model.base(x)
-                output = self.model.head(rep + self.client_mean)
+                output = self.model.head(rep + self.dbe.client_mean)
 
                 test_acc += (torch.sum(torch.argmax(output, dim=1) == y)).item()
                 test_num += y.shape[0]
@@ -149,7 +135,6 @@ class clientDBE(Client):
                 if self.num_classes == 2:
                     lb = lb[:, :2]
                 y_true.append(lb)
-                reps.extend(rep.detach())
 
         y_prob = np.concatenate(y_prob, axis=0)
         y_true = np.concatenate(y_true, axis=0)
@@ -2,13 +2,16 @@ import copy
 import torch
 import torch.nn as nn
 import numpy as np
+import os
 import time
 
 from flcore.clients.clientbase import Client
-from flcore.utils.fcil_utils import entropy, get_one_hot
+from flcore.utils.fcil_utils import get_one_hot, ExemplarMemory, RunningEntropy, herding_selection
+from flcore.utils.fcil_utils import DistillCache, IndexedDataset
 from flcore.trainmodel.models import LeNet2, weights_init
 
 import torch.optim as optim
+from torch.utils.data import DataLoader
 from torch.nn import functional as F
 from torch.autograd import Variable
 from torchvision import transforms
@@ -18,12 +21,16 @@ import random
 
 
 class clientFCIL(Client):
+    checkpoint_attrs = Client.checkpoint_attrs + [
+        'class_mean_set', 'learned_numclass', 'learned_classes', 'start', 'signal',
+        'last_class', 'task_id_old', 'last_entropy', 'distill_version']
+
     def __init__(self, args, id, train_data, test_data, train_samples, test_samples, **kwargs):
         super().__init__(args, id, train_data, test_data, train_samples, test_samples, **kwargs)
-        self.exemplar_set = []
         self.class_mean_set = []
         self.learned_numclass = 0
         self.learned_classes = []
+        self.learned_mask = torch.zeros(self.num_classes, dtype=torch.bool, device=self.device)
         self.transform = transforms.Compose([#transforms.Resize(img_size),
                                              transforms.ToTensor(),
                                             transforms.Normalize((0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761))])
@@ -34,12 +41,31 @@ class clientFCIL(Client):
 
         self.memory_size = args.memory_size
         self.task_size = 2      # Check it out later
+        self.replay_batch_size = args.replay_batch_size
+
+        mmap_path = None
+        if args.exemplar_mmap:
+            # one directory per run, so concurrent runs (e.g. a sweep) do not share files
+            mmap_dir = os.path.join(self.save_folder_name, "{}_{}_{}_{}".format(
+                args.dataset, args.algorithm, args.goal, kwargs.get('times', 0)))
+            if not os.path.exists(mmap_dir):
+                os.makedirs(mmap_dir)
+            mmap_path = os.path.join(mmap_dir, "client_" + str(self.id) + "_exemplar.npy")
+        self.exemplar_memory = ExemplarMemory(self.memory_size, mmap_path=mmap_path)
+        self.index_train_data()
 
         self.last_class = None
         self.task_id_old = -1
         self.last_entropy = 0
+        self.entropy_batches = args.entropy_batches
+        self.entropy_piggyback = args.entropy_piggyback
+        self.train_entropy = RunningEntropy()
+        self.train_entropy_round = None  # global round train_entropy was recorded in
 
         self.old_model = None
+        self.distill_cache = DistillCache(self.device) if args.distill_cache else None
+        self.distill_model = None
+        self.distill_version = 0
         self.encode_model = LeNet2(num_classes=1000).to(self.device)
         self.encode_model.apply(weights_init)
 
@@ -48,6 +74,45 @@ class clientFCIL(Client):
                                              transforms.Normalize((0.5071, 0.4867, 0.4408),
                                                                  (0.2675, 0.2565, 0.2761))])
 
+    def checkpoint_fingerprint(self):
+        return super().checkpoint_fingerprint() + (self.exemplar_memory.version, self.learned_numclass)
+
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state['learned_mask'] = self.learned_mask
+        state['exemplar_memory'] = self.exemplar_memory.state_dict()
+        return state
+
+    def load_checkpoint_state(self, state):
+        super().load_checkpoint_state(state)
+        self.learned_mask = state['learned_mask'].to(self.device)
+        self.exemplar_memory.load_state_dict(state['exemplar_memory'])
+        if self.distill_cache is not None:
+            self.distill_cache = DistillCache(self.device)
+
+    @property
+    def exemplar_set(self):
+        return [self.exemplar_memory.get_class(label) for label in self.exemplar_memory.classes]
+
+    def next_task(self, train, test, label_info=None, if_label=True):
+        super().next_task(train, test, label_info, if_label)
+        self.train_source = [image for image, _ in self.train_data]
+        self.index_train_data()
+
+    def index_train_data(self):
+        """
+        Stack the training images once and group sample indices by class,
+        so per-class lookups do not rescan the whole training list.
+        """
+        self.train_source = np.stack([np.asarray(image) for image in self.train_source])
+        targets = np.array([int(label) for label in self.train_targets], dtype=np.int64)
+        order = np.argsort(targets, kind='stable')
+        classes, starts, counts = np.unique(targets[order], return_index=True, return_counts=True)
+        self.class_index = {int(c): order[s:s + n] for c, s, n in zip(classes, starts, counts)}
+
+    def class_images(self, label):
+        index = self.class_index.get(int(label), np.empty(0, dtype=np.int64))
+        return self.train_source[index]
 
     def train(self, ep_g, model_old):
         self.train_loader = self.load_train_data()
@@ -72,10 +137,20 @@ class clientFCIL(Client):
             if self.signal:
                 self.old_model = model_old[0]
 
+        train_loader = self.train_loader
         if self.old_model != None:
             print('load old model')
             self.old_model.eval()
-
+            if self.distill_cache is not None:
+                if self.old_model is not self.distill_model:
+                    self.distill_model = self.old_model
+                    self.distill_version += 1
+                version = getattr(self.old_model, 'snapshot_version', self.distill_version)
+                self.distill_cache.prepare((self.current_task, version), len(self.train_data))
+                train_loader = DataLoader(IndexedDataset(self.train_data), self.batch_size, drop_last=True, shuffle=True)
+
+        self.train_entropy.reset()
+        self.train_entropy_round = ep_g
         for epoch in range(max_local_epochs):
             loss_cur_sum, loss_mmd_sum = [], []
             if (epoch + ep_g * 20) % 200 == 100:
@@ -96,11 +171,17 @@ class clientFCIL(Client):
                 else:
                     for p in opt.param_groups:
                         p['lr'] = self.learning_rate / 125
-            for step, (images, target) in enumerate(self.train_loader):
-                images, target = images.cuda(self.device), target.cuda(self.device)
-                if self.train_slow:
-                    time.sleep(0.1 * np.abs(np.random.rand()))
-                loss_value = self._compute_loss(images, target)
+            for step, batch in enumerate(train_loader):
+                images, target = batch[0].cuda(self.device), batch[1].cuda(self.device)
+                index = batch[2].cuda(self.device) if len(batch) > 2 else None
+                num_current = target.size(0)
+                if self.replay_batch_size > 0 and len(self.exemplar_memory) > 0:
+                    replay_images, replay_target = self.exemplar_memory.sample(self.replay_batch_size, self.device)
+                    images = torch.cat((images, replay_images.type_as(images)), dim=0)
+                    target = torch.cat((target, replay_target.type_as(target)), dim=0)
+                self.train_time_cost['num_samples'] += len(target)
+                loss_value = self._compute_loss(images, target, index=index,
+                                                entropy_rows=num_current if epoch == 0 else 0)
                 opt.zero_grad()
                 loss_value.backward()
                 opt.step()
@@ -111,8 +192,11 @@ class clientFCIL(Client):
     """
         Compute loss function
     """
-    def _compute_loss(self, imgs, label):
+    def _compute_loss(self, imgs, label, index=None, entropy_rows=0):
         output = self.model(imgs)
+        if entropy_rows > 0 and self.entropy_piggyback:
+            # current-task rows only, replayed exemplars follow them
+            self.train_entropy.update(output[:entropy_rows])
 
         target = get_one_hot(label, self.num_classes, self.device)
         output, target = output.cuda(self.device), target.cuda(self.device)
@@ -126,13 +210,32 @@ class clientFCIL(Client):
             loss_cur = torch.mean(w * F.binary_cross_entropy_with_logits(output, target, reduction='none'))
 
             distill_target = target.clone()
-            old_target = torch.sigmoid(self.old_model(imgs))
+            old_target = self._distill_target(imgs, index)
             old_task_size = old_target.shape[1]
-            distill_target[..., :old_task_size] = old_targetself.train_loader
+            distill_target[..., :old_task_size] = old_target
             loss_old = F.binary_cross_entropy_with_logits(output, distill_target)
 
             return 0.5 * loss_cur + 0.5 * loss_old
 
+    def _distill_target(self, imgs, index=None):
+        """
+        Sigmoid outputs of the old model. Rows with a dataset ``index`` are served
+        from the distillation cache once filled; trailing rows without an index
+        (replayed exemplars) always go through the old model.
+        """
+        with torch.no_grad():
+            if self.distill_cache is None or index is None:
+                return torch.sigmoid(self.old_model(imgs))
+
+            n = index.size(0)
+            old_target = self.distill_cache.lookup(index)
+            if old_target is None:
+                old_target = torch.sigmoid(self.old_model(imgs[:n]))
+                self.distill_cache.store(index, old_target)
+            if imgs.size(0) > n:
+                old_target = torch.cat((old_target, torch.sigmoid(self.old_model(imgs[n:]))), dim=0)
+            return old_target
+
     def beforeTrain(self, task_id_new, group):
         if task_id_new != self.task_id_old:
             self.task_id_old = task_id_new
@@ -143,59 +246,43 @@ class clientFCIL(Client):
             else:
                 self.last_class = None
 
-    def update_new_set(self):
+    def update_new_set(self, ep_g=None):
         self.model.eval()
         self.signal = False
-        self.signal = self.entropy_signal(self.train_loader)
+        self.signal = self.entropy_signal(self.train_loader, ep_g)
 
         if self.signal and (self.last_class != None):
             self.learned_numclass += len(self.last_class)
             self.learned_classes += self.last_class
+            self.learned_mask[torch.as_tensor([int(c) for c in self.last_class], dtype=torch.long, device=self.device)] = True
 
             m = int(self.memory_size / self.learned_numclass)
             self._reduce_exemplar_sets(m)
-            for i in self.last_class:
-                mask = np.array(self.train_targets) == i
-                images = np.array(self.train_source)[mask]
-                self._construct_exemplar_set(images, m)
+            self._construct_exemplar_sets(self.last_class, m)
 
         self.model.train()
 
     def efficient_old_class_weight(self, output, label):
-        pred = torch.sigmoid(output)
-
-        N, C = pred.size(0), pred.size(1)
-
-        class_mask = pred.data.new(N, C).fill_(0)
-        class_mask = Variable(class_mask)
+        """
+        Per-sample weights that rebalance old and new classes: the gradient
+        magnitude of each sample, normalized by the mean over its own group.
+        ``learned_mask`` is a device lookup table, so the cost does not grow
+        with the number of learned classes.
+        """
         ids = label.view(-1, 1)
-        class_mask.scatter_(1, ids.data, 1.)
+        if len(self.learned_classes) == 0:
+            return torch.ones(ids.size(0), 1, dtype=output.dtype, device=output.device)
 
-        target = get_one_hot(label, self.num_classes, self.device)
-        g = torch.abs(pred.detach() - target)
-        g = (g * class_mask).sum(1).view(-1, 1)
-
-        if len(self.learned_classes) != 0:
-            for i in self.learned_classes:
-                ids = torch.where(ids != i, ids, ids.clone().fill_(-1))
-
-            index1 = torch.eq(ids, -1).float()
-            index2 = torch.ne(ids, -1).float()
-            if index1.sum() != 0:
-                w1 = torch.div(g * index1, (g * index1).sum() / index1.sum())
-            else:
-                w1 = g.clone().fill_(0.)
-            if index2.sum() != 0:
-                w2 = torch.div(g * index2, (g * index2).sum() / index2.sum())
-            else:
-                w2 = g.clone().fill_(0.)
-
-            w = w1 + w2
+        # |sigmoid(output) - one_hot| at the target column
+        g = 1. - torch.sigmoid(output.detach()).gather(1, ids)
 
-        else:
-            w = g.clone().fill_(1.)
+        old = self.learned_mask[label].view(-1, 1)
+        old_f = old.to(g.dtype)
+        new_f = 1. - old_f
+        old_mean = (g * old_f).sum() / old_f.sum().clamp(min=1.)
+        new_mean = (g * new_f).sum() / new_f.sum().clamp(min=1.)
 
-        return w
+        return torch.where(old, g / old_mean, g / new_mean)
 
     def proto_grad_sharing(self):
         if self.signal:
@@ -216,8 +303,7 @@ class clientFCIL(Client):
                                              transforms.ToTensor(),
                                             transforms.Normalize((0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761))])
         for i in self.current_labels:
-            mask = np.array(self.train_targets) == i
-            images = np.array(self.train_source)[mask]
+            images = self.class_images(i)
             class_mean, feature_extractor_output = self.compute_class_mean(images, self.transform)
             dis = class_mean - feature_extractor_output
             dis = np.linalg.norm(dis, axis=1)
@@ -259,27 +345,37 @@ class clientFCIL(Client):
 
         return proto_grad
 
-    def entropy_signal(self, loader):
-        self.model.eval()
-        start_ent = True
+    def entropy_signal(self, loader, ep_g=None):
+        """
+        Task-shift detector: flags a jump of the mean prediction entropy.
+
+        With ``entropy_piggyback`` the mean over the current-task rows of the first
+        local epoch is reused when that epoch ran in the previous global round
+        (``ep_g - 1``), which removes the extra inference pass at the cost of
+        detecting a shift one round later. Those outputs come from the model in
+        train mode. The recorded mean is read at most once; without a fresh one
+        at most ``entropy_batches`` batches of the shuffled loader are scored in
+        eval mode (0 = all).
+        """
         res = False
 
-        for step, (imgs, labels) in enumerate(loader):
-            imgs, labels = imgs.cuda(self.device), labels.cuda(self.device)
+        overall_avg = None
+        if self.entropy_piggyback and ep_g is not None and self.train_entropy_round == ep_g - 1:
+            overall_avg = self.train_entropy.mean()
+        self.train_entropy.reset()
+        self.train_entropy_round = None
+        if overall_avg is None:
+            self.model.eval()
+            meter = RunningEntropy()
             with torch.no_grad():
-                outputs = self.model(imgs)
-            softmax_out = nn.Softmax(dim=1)(outputs)
-            ent = entropy(softmax_out)
-
-            if start_ent:
-                all_ent = ent.float().cpu()
-                all_label = labels.long().cpu()
-                start_ent = False
-            else:
-                all_ent = torch.cat((all_ent, ent.float().cpu()), 0)
-                all_label = torch.cat((all_label, labels.long().cpu()), 0)
+                for step, (imgs, labels) in enumerate(loader):
+                    if self.entropy_batches > 0 and step >= self.entropy_batches:
+                        break
+                    meter.update(self.model(imgs.cuda(self.device)))
+            overall_avg = meter.mean()
+            if overall_avg is None:
+                overall_avg = self.last_entropy
 
-        overall_avg = torch.mean(all_ent).item()
         if overall_avg - self.last_entropy > 1.2:
             res = True
 
@@ -290,22 +386,26 @@ class clientFCIL(Client):
         return res
 
     def _reduce_exemplar_sets(self, m):
-        for index in range(len(self.exemplar_set)):
-            self.exemplar_set[index] = self.exemplar_set[index][:m]
-
-    def _construct_exemplar_set(self, images, m):
-        class_mean, feature_extractor_output = self.compute_class_mean(images, self.transform)
-        exemplar = []
-        now_class_mean = np.zeros((1, 512))
-
-        for i in range(m):
-            x = class_mean - (now_class_mean + feature_extractor_output) / (i + 1)
-            x = np.linalg.norm(x, axis=1)
-            index = np.argmin(x)
-            now_class_mean += feature_extractor_output[index]
-            exemplar.append(images[index])
-
-        self.exemplar_set.append(exemplar)
+        self.exemplar_memory.reduce(m)
+
+    def _construct_exemplar_sets(self, labels, m):
+        labels = [int(label) for label in labels]
+        index = [self.class_index.get(label, np.empty(0, dtype=np.int64)) for label in labels]
+        targets = torch.from_numpy(np.repeat(labels, [len(i) for i in index])).to(self.device)
+        images = self.train_source[np.concatenate(index)]
+
+        features = self.extract_features(images)
+        picks = herding_selection(features, targets, labels, m)
+        for label, pick in zip(labels, picks):
+            self.exemplar_memory.add_class(label, images[pick.cpu().numpy()], features[pick].cpu().numpy())
+
+    def extract_features(self, images, batch_size=256):
+        features = []
+        with torch.no_grad():
+            for start in range(0, len(images), batch_size):
+                x = self.Image_transform(images[start:start + batch_size], self.transform).cuda(self.device)
+                features.append(F.normalize(self.model.base(x)))
+        return torch.cat(features, dim=0)
 
     def compute_exemplar_class_mean(self):
         self.class_mean_set = []
@@ -0,0 +1,185 @@
+import copy
+import importlib
+
+
+# Algorithms, models and datasets register a factory and their capabilities here.
+# Nothing heavy is imported until an entry is built, so the tables can be read
+# (e.g. for argparse choices) at no cost and many configurations can be built
+# in one process.
+
+ALGORITHMS = {}
+MODELS = {}
+DATASETS = {}
+
+
+class Algorithm():
+    """ A server class and what it supports.
+
+    Args:
+        module, cls: Where the server class lives; imported on first use.
+        head_split: The model is wrapped in ``BaseHeadSplit`` (feature extractor + head).
+        parallel_clients: Client work goes through ``Server.run_clients``, so
+            ``num_workers > 1`` has an effect.
+        compression: Uploads and broadcasts go through the ``Server`` codec paths
+            (``uplink_codec`` / ``downlink_codec``).
+        asynchronous: The training loop has the buffered asynchronous mode (``async_mode``).
+        checkpoint: The training loop saves and resumes checkpoints (``ckpt_gap`` / ``resume``).
+    """
+    def __init__(self, name, module, cls, head_split=False, parallel_clients=False, compression=False,
+                 asynchronous=False, checkpoint=False):
+        self.name = name
+        self.module = module
+        self.cls = cls
+        self.head_split = head_split
+        self.parallel_clients = parallel_clients
+        self.compression = compression
+        self.asynchronous = asynchronous
+        self.checkpoint = checkpoint
+
+    def server_class(self):
+        return getattr(importlib.import_module(self.module), self.cls)
+
+
+def register_algorithm(name, module, cls, **capabilities):
+    ALGORITHMS[name] = Algorithm(name, module, cls, **capabilities)
+    return ALGORITHMS[name]
+
+
+def register_model(name):
+    """ Decorator registering ``builder(args) -> nn.Module`` under ``name``. """
+    def wrapper(builder):
+        MODELS[name] = builder
+        return builder
+    return wrapper
+
+
+def register_dataset(name, loader, num_classes):
+    """ ``loader(args)`` returns the server-side data handed to ``read_client_data_FCL``,
+    or None when clients read their shards themselves. """
+    DATASETS[name] = {'loader': loader, 'num_classes': num_classes}
+
+
+register_algorithm('FedAvg', 'flcore.servers.serveravg', 'FedAvg',
+                   head_split=True, compression=True, asynchronous=True, checkpoint=True)
+register_algorithm('FedALA', 'flcore.servers.serverala', 'FedALA',
+                   parallel_clients=True, compression=True, checkpoint=True)
+register_algorithm('FedDBE', 'flcore.servers.serverdbe', 'FedDBE',
+                   head_split=True, parallel_clients=True, compression=True, checkpoint=True)
+register_algorithm('FedFCIL', 'flcore.servers.serverfcil', 'FedFCIL',
+                   head_split=True, compression=True, checkpoint=True)
+register_algorithm('FedSTGM', 'flcore.servers.serverstgm', 'FedSTGM',
+                   head_split=True, compression=True, asynchronous=True, checkpoint=True)
+register_algorithm('FedAS', 'flcore.servers.serveras', 'FedAS',
+                   head_split=True, compression=True, checkpoint=True)
+register_algorithm('FedWeIT', 'flcore.servers.serverweit', 'FedWeIT',
+                   compression=True)
+
+
+@register_model('CNN')
+def cnn(args):
+    from flcore.trainmodel.models import FedAvgCNN
+    if "CIFAR100" in args.dataset or "IMAGENET1k" in args.dataset:
+        return FedAvgCNN(in_features=3, num_classes=args.num_classes, dim=1600)
+    return FedAvgCNN(in_features=3, num_classes=args.num_classes, dim=10816)
+
+
+@register_model('ResNet18')
+def resnet18(args):
+    import torchvision
+    return torchvision.models.resnet18(pretrained=False, num_classes=args.num_classes)
+
+
+@register_model('ResNet10')
+def resnet10(args):
+    from flcore.trainmodel.resnet import resnet10
+    return resnet10(num_classes=args.num_classes)
+
+
+def split_file_dataset(args):
+    from utils.dataset import get_dataset
+    return get_dataset(args, args.dataset, args.datadir, args.data_split_file)
+
+
+def no_dataset(args):
+    # IMAGENET1k clients read their task shards from disk (read_client_data_FCL_imagenet1k)
+    return None
+
+
+register_dataset('EMNIST-Letters', split_file_dataset, num_classes=26)
+register_dataset('EMNIST-Letters-malicious', split_file_dataset, num_classes=26)
+register_dataset('EMNIST-Letters-shuffle', split_file_dataset, num_classes=26)
+register_dataset('CIFAR100', split_file_dataset, num_classes=100)
+register_dataset('MNIST-SVHN-FASHION', split_file_dataset, num_classes=20)
+register_dataset('IMAGENET1k', no_dataset, num_classes=1000)
+
+
+def get_algorithm(algorithm):
+    if algorithm not in ALGORITHMS:
+        raise NotImplementedError(algorithm)
+    return ALGORITHMS[algorithm]
+
+
+def get_server(algorithm):
+    return get_algorithm(algorithm).server_class()
+
+
+def build_model(model_str, args):
+    if model_str not in MODELS:
+        raise NotImplementedError(model_str)
+    return MODELS[model_str](args).to(args.device)
+
+
+# (dataset, datadir, split file, malicious clients) -> loaded data, shared by every
+# server built in this process (and by processes forked from it)
+DATASET_CACHE = {}
+
+
+def dataset_key(args):
+    return (args.dataset, args.datadir, args.data_split_file, getattr(args, 'malicious_client_num', None))
+
+
+def load_dataset(args):
+    """ Data of ``args.dataset``, loaded once per process; servers only read it. """
+    if args.dataset not in DATASETS:
+        raise NotImplementedError(args.dataset)
+    key = dataset_key(args)
+    if key not in DATASET_CACHE:
+        DATASET_CACHE[key] = DATASETS[args.dataset]['loader'](args)
+    return DATASET_CACHE[key]
+
+
+def clear_dataset_cache():
+    DATASET_CACHE.clear()
+
+
+def check_capabilities(algorithm, args):
+    """ Reject options the algorithm cannot honour; ``num_workers`` just falls back to 1. """
+    if not algorithm.compression and (args.uplink_codec != 'none' or args.downlink_codec != 'none'):
+        raise ValueError("{} does not support update compression".format(algorithm.name))
+    if not algorithm.asynchronous and args.async_mode:
+        raise ValueError("{} has no asynchronous mode".format(algorithm.name))
+    if not algorithm.checkpoint and (args.ckpt_gap > 0 or args.resume):
+        raise ValueError("{} does not support checkpoints (ckpt_gap / resume)".format(algorithm.name))
+    if not algorithm.parallel_clients and args.num_workers > 1:
+        print("{} trains clients sequentially, ignoring num_workers={}".format(algorithm.name, args.num_workers))
+        args.num_workers = 1
+
+
+def build_server(args, times):
+    """ Create the server of ``args.algorithm`` around a fresh ``args.model``.
+
+    ``args`` is not modified: the server gets a copy holding the built model (and
+    head), so one config can be built repeatedly in the same process.
+    """
+    algorithm = get_algorithm(args.algorithm)
+    args = copy.copy(args)
+    check_capabilities(algorithm, args)
+
+    args.model = build_model(args.model, args)
+    if algorithm.head_split:
+        import torch.nn as nn
+        from flcore.trainmodel.models import BaseHeadSplit
+        args.head = copy.deepcopy(args.model.fc)
+        args.model.fc = nn.Identity()
+        args.model = BaseHeadSplit(args.model, args.head)
+    return algorithm.server_class()(args, times)
@@ -1,4 +1,5 @@
 import time
+import numpy as np
 from flcore.clients.clientala import clientALA
 from flcore.servers.serverbase import Server
 from threading import Thread
@@ -20,7 +21,12 @@ class FedALA(Server):
 
 
     def train(self):
+        self.resume_checkpoint()
+        self.restore_clients(0)
+
         for i in range(self.global_rounds+1):
+            if self.skip_round(0, i):
+                continue
             s_t = time.time()
             self.selected_clients = self.select_clients()
             self.send_models()
@@ -28,7 +34,7 @@ class FedALA(Server):
             if i%self.eval_gap == 0:
                 print(f"\n-------------Round number: {i}-------------")
                 print("\nEvaluate global model")
-                self.evaluate()
+                self.evaluate(glob_iter=i)
 
             for client in self.selected_clients:
                 client.train()
@@ -45,6 +51,7 @@ class FedALA(Server):
 
             self.Budget.append(time.time() - s_t)
             print('-'*25, 'time cost', '-'*25, self.Budget[-1])
+            self.save_checkpoint(0, i)
 
             if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
                 break
@@ -52,7 +59,7 @@ class FedALA(Server):
         print("\nBest accuracy.")
         # self.print_(max(self.rs_test_acc), max(
         #     self.rs_train_acc), min(self.rs_train_loss))
-        print(max(self.rs_test_acc))
+        print(self.rs_test_acc.best)
         print("\nAverage time cost per round.")
         print(sum(self.Budget[1:])/len(self.Budget[1:]))
 
@@ -64,11 +71,20 @@ class FedALA(Server):
             self.set_new_clients(clientALA)
             print(f"\n-------------Fine tuning round-------------")
             print("\nEvaluate new clients")
-            self.evaluate()
+            self.evaluate(glob_iter=i)
 
 
     def send_models(self):
-        assert (len(self.clients) > 0)
-
-        for client in self.clients:
-            client.local_initialization(self.global_model)
\ No newline at end of file
+        assert (len(self.selected_clients) > 0)
+
+        # Only clients that train this round run ALA. The others are deferred
+        # and initialized against the then-current global model once selected.
+        self.publish_global()
+        received = {client.id: self.deliver(client) for client in self.selected_clients}
+        # ALA samples its data with per-client seeds drawn here, in selection order,
+        # so that runs stay reproducible when clients run on parallel threads
+        round_seed = np.random.randint(2**31)
+        seeds = {client.id: int(np.random.SeedSequence([round_seed, client.id]).generate_state(1)[0])
+                 for client in self.selected_clients}
+        self.run_clients(lambda client: client.local_initialization(received[client.id], seeds[client.id]),
+                         self.selected_clients)
\ No newline at end of file
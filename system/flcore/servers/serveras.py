@@ -26,36 +26,46 @@ class FedAS(Server):
     def send_selected_models(self, selected_ids, epoch):
         assert (len(self.clients) > 0)
 
+        self.publish_global()
         # for client in self.clients:
         for client in [client for client in self.clients if (client.id in selected_ids)]:
-            start_time = time.time()
-
             progress = epoch / self.global_rounds
             
-            client.set_parameters(self.global_model, progress)
-
-            client.send_time_cost['num_rounds'] += 1
-            client.send_time_cost['total_cost'] += 2 * (time.time() - start_time)    
+            client.set_parameters(self.deliver(client), progress)
     
     def aggregate_wrt_fisher(self):
         assert (len(self.uploaded_models) > 0)
 
-        self.global_model = copy.deepcopy(self.uploaded_models[0])
-        for param in self.global_model.parameters():
-            param.data.zero_()
-
         # calculate the aggregrate weight with respect to the FIM value of model
         FIM_weight_list = []
         for id in self.uploaded_ids:
             FIM_weight_list.append(self.clients[id].fim_trace_history[-1])
         # normalization to obtain weight
-        FIM_weight_list = [FIM_value/sum(FIM_weight_list) for FIM_value in FIM_weight_list]
+        FIM_weight_list = [max(FIM_value, 0.) for FIM_value in FIM_weight_list]
+        if sum(FIM_weight_list) > 0:
+            FIM_weight_list = [FIM_value/sum(FIM_weight_list) for FIM_value in FIM_weight_list]
+        else:
+            # no curvature information (e.g. all gradients vanished): weight by samples
+            FIM_weight_list = list(self.uploaded_weights)
+
+        if self.uploaded_updates:
+            self.uploaded_weights = FIM_weight_list
+            return self.aggregate_updates()
+
+        self.global_model = copy.deepcopy(self.uploaded_models[0])
+        for param in self.global_model.parameters():
+            param.data.zero_()
 
         for w, client_model in zip(FIM_weight_list, self.uploaded_models):
             self.add_parameters(w, client_model)
 
     def train(self):
+        self.resume_checkpoint()
+        self.restore_clients(0)
+
         for i in range(self.global_rounds+1):
+            if self.skip_round(0, i):
+                continue
             s_t = time.time()
             self.selected_clients = self.select_clients()
             self.alled_clients = self.all_clients()
@@ -69,7 +79,7 @@ class FedAS(Server):
             if i%self.eval_gap == 0:
                 print(f"\n-------------Round number: {i}-------------")
                 print("\nEvaluate global model")
-                self.evaluate()
+                self.evaluate(glob_iter=i)
 
             # self.send_models()
             self.send_selected_models(selected_ids, i)
@@ -99,6 +109,7 @@ class FedAS(Server):
 
             self.Budget.append(time.time() - s_t)
             print('-'*25, 'time cost', '-'*25, self.Budget[-1])
+            self.save_checkpoint(0, i)
 
             if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
                 break
@@ -106,15 +117,10 @@ class FedAS(Server):
         print("\nBest accuracy.")
         # self.print_(max(self.rs_test_acc), max(
         #     self.rs_train_acc), min(self.rs_train_loss))
-        print(max(self.rs_test_acc))
+        print(self.rs_test_acc.best)
         print("\nAverage time cost per round.")
         print(sum(self.Budget[1:])/len(self.Budget[1:]))
 
-        print(f'+++++++++++++++++++++++++++++++++++++++++')
-        gen_acc = self.avg_generalization_metrics()
-        print(f'Generalization Acc: {gen_acc}')
-        print(f'+++++++++++++++++++++++++++++++++++++++++')
-
         self.save_results()
         self.save_global_model()
 
@@ -123,7 +129,7 @@ class FedAS(Server):
             self.set_new_clients(clientAS)
             print(f"\n-------------Fine tuning round-------------")
             print("\nEvaluate new clients")
-            self.evaluate()
+            self.evaluate(glob_iter=i)
 
     def print_fim_histories(self):
         avg_fim_histories = []
@@ -28,6 +28,7 @@ class FedAvg(Server):
         else:
             N_TASKS = len(self.data['train_data'][self.data['client_names'][0]]['x'])
         print(str(N_TASKS) + " tasks are available")
+        self.resume_checkpoint()
 
         for task in range(N_TASKS):
 
@@ -74,41 +75,49 @@ class FedAvg(Server):
                     u.available_labels_current = list(available_labels_current)
                     u.available_labels_past = list(available_labels_past)
 
-            for i in range(self.global_rounds):
+            self.restore_clients(task)
 
-                glob_iter = i + self.global_rounds * task
-                s_t = time.time()
-                self.selected_clients = self.select_clients()
-                self.send_models()
+            if self.async_mode:
+                glob_iter = self.train_async(task)
+            else:
+                for i in range(self.global_rounds):
+
+                    glob_iter = i + self.global_rounds * task
+                    if self.skip_round(task, i):
+                        continue
+                    s_t = time.time()
+                    self.selected_clients = self.select_clients()
+                    self.send_models()
 
-                if i%self.eval_gap == 0:
-                    print(f"\n-------------Round number: {i}-------------")
-                    print("\nEvaluate global model")
-                    self.evaluate(glob_iter=glob_iter)
+                    if i%self.eval_gap == 0:
+                        print(f"\n-------------Round number: {i}-------------")
+                        print("\nEvaluate global model")
+                        self.evaluate(glob_iter=glob_iter)
 
-                for client in self.selected_clients:
-                    client.train()
+                    for client in self.selected_clients:
+                        client.train()
 
-                # threads = [Thread(target=client.train)
-                #            for client in self.selected_clients]
-                # [t.start() for t in threads]
-                # [t.join() for t in threads]
+                    # threads = [Thread(target=client.train)
+                    #            for client in self.selected_clients]
+                    # [t.start() for t in threads]
+                    # [t.join() for t in threads]
 
-                self.receive_models()
-                if self.dlg_eval and i%self.dlg_gap == 0:
-                    self.call_dlg(i)
-                self.aggregate_parameters()
+                    self.receive_models()
+                    if self.dlg_eval and i%self.dlg_gap == 0:
+                        self.call_dlg(i)
+                    self.aggregate_parameters()
 
-                self.Budget.append(time.time() - s_t)
-                print('-'*25, 'time cost', '-'*25, self.Budget[-1])
+                    self.Budget.append(time.time() - s_t)
+                    print('-'*25, 'time cost', '-'*25, self.Budget[-1])
+                    self.save_checkpoint(task, i)
 
-                if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
-                    break
+                    if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
+                        break
 
             print("\nBest accuracy.")
             # self.print_(max(self.rs_test_acc), max(
             #     self.rs_train_acc), min(self.rs_train_loss))
-            print(max(self.rs_test_acc))
+            print(self.rs_test_acc.best)
             print("\nAverage time cost per round.")
             print(sum(self.Budget[1:])/len(self.Budget[1:]))
 
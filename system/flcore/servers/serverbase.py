@@ -1,17 +1,24 @@
 import os
 import sys
 import torch
-import wandb
-import glog as logger
+import logging
 import numpy as np
-import h5py
 import copy
 import time
 import random
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
+from flcore.utils.compression_utils import UplinkCodec, make_uplink_codec, make_downlink, payload_nbytes
+from flcore.utils.network_utils import NetworkSimulator
+from flcore.utils.selection_utils import make_selector
+from flcore.utils.checkpoint_utils import Checkpointer, to_device
 from utils.data_utils import read_client_data
-from utils.dlg import DLG
-from utils.dataset import get_dataset
+from flcore.registry import load_dataset
 from utils.model_utils import read_client_data_FCL, read_client_data_FCL_imagenet1k
+from utils.result_utils import MetricsWriter, MetricHistory
+
+logger = logging.getLogger(__name__)
 
 class Server(object):
     def __init__(self, args, times):
@@ -19,10 +26,7 @@ class Server(object):
         self.args = args
         self.device = args.device
         self.dataset = args.dataset
-        if self.args.dataset == 'IMAGENET1k':
-            self.data = None
-        else:
-            self.data = get_dataset(args, args.dataset, args.datadir, args.data_split_file)
+        self.data = load_dataset(args)
         self.num_classes = args.num_classes
         self.global_rounds = args.global_rounds
         self.local_epochs = args.local_epochs
@@ -36,11 +40,14 @@ class Server(object):
         self.current_num_join_clients = self.num_join_clients
         self.algorithm = args.algorithm
         self.time_select = args.time_select
+        self.selector = make_selector(args)
         self.goal = args.goal
         self.time_threthold = args.time_threthold
         self.save_folder_name = args.save_folder_name
         self.top_cnt = args.top_cnt
         self.auto_break = args.auto_break
+        self.num_workers = args.num_workers
+        self.client_executor = ThreadPoolExecutor(max_workers=self.num_workers) if self.num_workers > 1 else None
 
         self.clients = []
         self.selected_clients = []
@@ -50,12 +57,46 @@ class Server(object):
         self.uploaded_weights = []
         self.uploaded_ids = []
         self.uploaded_models = []
-
-        self.rs_test_acc = []
-        self.rs_test_auc = []
-        self.rs_train_loss = []
+        self.uploaded_updates = []
+        self.uploaded_bytes = []
+
+        # uplink compression, None uploads client models by reference
+        self.uplink_codec = make_uplink_codec(args, [p.shape for p in self.global_model.parameters()])
+        # downlink delta broadcast, None sends the full global model
+        self.downlink = make_downlink(args, [p.shape for p in self.global_model.parameters()])
+        self.round_downlink_bytes = {}
+
+        # buffered asynchronous aggregation (FedBuff)
+        self.async_mode = args.async_mode
+        self.async_buffer_size = args.async_buffer_size
+        self.async_staleness_exp = args.async_staleness_exp
+        self.model_version = 0
+        self.async_events = []
+        self.async_busy = set()
 
         self.times = times
+
+        # metric histories, bounded in memory and streamed to the results file
+        self.metrics = None
+        if args.metrics_flush > 0:
+            self.metrics = MetricsWriter(self.results_path(), flush_every=args.metrics_flush, resume=args.resume)
+        history = args.history_size
+        # without a writer, save_results writes the in-memory histories at the end, so keep them whole
+        saved_history = history if self.metrics is not None else 0
+        self.rs_test_acc = MetricHistory('rs_test_acc', saved_history, self.metrics)
+        self.rs_test_auc = MetricHistory('rs_test_auc', saved_history, self.metrics)
+        self.rs_train_loss = MetricHistory('rs_train_loss', saved_history, self.metrics, mode='min')
+        self.rs_uplink_bytes = MetricHistory('rs_uplink_bytes', history, mode=None)  # per round: {client id: encoded bytes}
+        self.rs_downlink_bytes = MetricHistory('rs_downlink_bytes', history, mode=None)  # per round: {client id: broadcast bytes}
+        # simulated wall clock at the end of each round
+        self.rs_sim_time = MetricHistory('rs_sim_time', history, self.metrics, mode=None)
+        # simulated wall clock of each rs_test_acc entry
+        self.rs_eval_sim_time = MetricHistory('rs_eval_sim_time', history, self.metrics, mode=None)
+        # seconds spent in select_clients
+        self.rs_selection_overhead = MetricHistory('rs_selection_overhead', history, self.metrics, mode=None)
+        # simulated duration of each synchronous round
+        self.rs_round_latency = MetricHistory('rs_round_latency', history, self.metrics, mode=None)
+
         self.eval_gap = args.eval_gap
         self.client_drop_rate = args.client_drop_rate
         self.train_slow_rate = args.train_slow_rate
@@ -77,6 +118,14 @@ class Server(object):
         self.task_dict = {}
         self.current_task = 0
 
+        # checkpointing and resume
+        self.checkpointer = None
+        if args.ckpt_gap > 0 or args.resume:
+            ckpt_dir = os.path.join(args.ckpt_dir, "{}_{}_{}_{}".format(self.dataset, self.algorithm, self.goal, self.times))
+            self.checkpointer = Checkpointer(ckpt_dir, gap=args.ckpt_gap)
+        self.resume_state = None
+        self.resume_point = None  # (task, round) training continues from
+
     def set_clients(self, clientObj):
         total_clients = 10
         for i, train_slow, send_slow in zip(range(self.num_clients), self.train_slow_clients, self.send_slow_clients):
@@ -98,7 +147,8 @@ class Server(object):
                             train_samples=len(train_data), 
                             test_samples=len(test_data), 
                             train_slow=train_slow, 
-                            send_slow=send_slow)
+                            send_slow=send_slow,
+                            times=self.times)
             self.clients.append(client)
 
             # update classes so far & current labels
@@ -106,6 +156,8 @@ class Server(object):
             client.current_labels.extend(label_info['labels'])
             client.task_dict[0] = label_info['labels']
 
+        self.simulator = NetworkSimulator.from_args(self.args, self.train_slow_clients, self.send_slow_clients)
+
         logger.info("Number of Train/Test samples: %d/%d"%(self.total_train_samples, self.total_test_samples))
         logger.info("Data from {} clients in total.".format(total_clients))
         logger.info("Finished creating FedAvg server.")
@@ -131,20 +183,60 @@ class Server(object):
             self.current_num_join_clients = np.random.choice(range(self.num_join_clients, self.num_clients+1), 1, replace=False)[0]
         else:
             self.current_num_join_clients = self.num_join_clients
-        selected_clients = list(np.random.choice(self.clients, self.current_num_join_clients, replace=False))
+
+        start_time = time.time()
+        selected_clients = self.selector.select(self, self.current_num_join_clients)
+        overhead = time.time() - start_time
+        self.rs_selection_overhead.append(overhead)
+        print("Selected %d clients (%s) in %.4fs" % (len(selected_clients), self.selector.name, overhead))
 
         return selected_clients
 
+    def run_clients(self, fn, clients):
+        """Apply fn to every client, through the shared client executor when num_workers > 1."""
+        if self.client_executor is None:
+            return [fn(client) for client in clients]
+        return list(self.client_executor.map(fn, clients))
+
+    def publish_global(self):
+        """ Start a broadcast round: record the global model as the version clients catch up to. """
+        self.round_downlink_bytes = {}
+        self.rs_downlink_bytes.append(self.round_downlink_bytes)
+        if self.downlink is not None:
+            self.downlink.publish(self.global_model)
+
+    def deliver(self, client):
+        """ The global model as the client receives it, counting the bytes broadcast to it. """
+        if self.downlink is None:
+            model = self.global_model
+            nbytes = sum(payload_nbytes(p) for p in self.global_model.parameters())
+        else:
+            kind, payload = self.downlink.encode(client.id)
+            model = client.receive_broadcast(kind, payload, self.downlink.codec)
+            nbytes = payload_nbytes(payload)
+        client.send_time_cost['num_rounds'] += 1
+        client.send_time_cost['total_cost'] += self.simulator.download_time(client.id, nbytes)
+        client.send_time_cost['total_bytes'] += nbytes
+        self.round_downlink_bytes[client.id] = nbytes
+        return model
+
+    def charge_round(self, client, up_bytes):
+        """
+        Simulated time of the client's round: the download counted by ``deliver``,
+        training on the samples processed since it was last charged and the upload.
+        Training and upload are recorded in ``train_time_cost['sim_cost']``.
+        """
+        compute = self.simulator.compute_time(client.id, self.simulator.trained_samples(client))
+        upload = self.simulator.upload_time(client.id, up_bytes)
+        client.train_time_cost['sim_cost'] += compute + upload
+        return self.simulator.download_time(client.id, self.round_downlink_bytes.get(client.id, 0)) + compute + upload
+
     def send_models(self):
         assert (len(self.clients) > 0)
 
+        self.publish_global()
         for client in self.clients:
-            start_time = time.time()
-            
-            client.set_parameters(self.global_model)
-
-            client.send_time_cost['num_rounds'] += 1
-            client.send_time_cost['total_cost'] += 2 * (time.time() - start_time)
+            client.set_parameters(self.deliver(client))
 
     def receive_models(self):
         assert (len(self.selected_clients) > 0)
@@ -155,20 +247,43 @@ class Server(object):
         self.uploaded_ids = []
         self.uploaded_weights = []
         self.uploaded_models = []
+        self.uploaded_updates = []
+        self.uploaded_bytes = []
+        if self.uplink_codec is not None:
+            global_flat = parameters_to_vector(self.global_model.parameters()).detach()
+        model_bytes = sum(payload_nbytes(p) for p in self.global_model.parameters())
+        round_times = []
         tot_samples = 0
         for client in active_clients:
-            try:
-                client_time_cost = client.train_time_cost['total_cost'] / client.train_time_cost['num_rounds'] + \
-                        client.send_time_cost['total_cost'] / client.send_time_cost['num_rounds']
-            except ZeroDivisionError:
-                client_time_cost = 0
+            payload = None
+            up_bytes = model_bytes
+            if self.uplink_codec is not None:
+                delta = parameters_to_vector(client.model.parameters()).detach() - global_flat
+                payload = self.uplink_codec.encode(client.id, delta)
+                up_bytes = payload_nbytes(payload)
+
+            # simulated download + local training + upload time of this round
+            client_time_cost = self.charge_round(client, up_bytes)
+            round_times.append(client_time_cost)
             if client_time_cost <= self.time_threthold:
                 tot_samples += client.train_samples
                 self.uploaded_ids.append(client.id)
                 self.uploaded_weights.append(client.train_samples)
                 self.uploaded_models.append(client.model)
+                self.uploaded_bytes.append(up_bytes)
+                if payload is not None:
+                    self.uploaded_updates.append(payload)
         for i, w in enumerate(self.uploaded_weights):
             self.uploaded_weights[i] = w / tot_samples
+        self.rs_uplink_bytes.append(dict(zip(self.uploaded_ids, self.uploaded_bytes)))
+
+        # the server waits for the slowest client, or until the threshold
+        round_latency = min(max(round_times), self.time_threthold) if len(round_times) > 0 else 0.
+        self.simulator.advance(round_latency)
+        self.rs_round_latency.append(round_latency)
+        self.rs_sim_time.append(self.simulator.clock)
+        print("Round latency %.2fs (simulated), %d/%d updates received" % (
+            round_latency, len(self.uploaded_ids), len(active_clients)))
 
     def receive_grads(self):
 
@@ -194,6 +309,9 @@ class Server(object):
     def aggregate_parameters(self):
         assert (len(self.uploaded_models) > 0)
 
+        if self.uploaded_updates:
+            return self.aggregate_updates()
+
         self.global_model = copy.deepcopy(self.uploaded_models[0])
         for param in self.global_model.parameters():
             param.data.zero_()
@@ -201,10 +319,186 @@ class Server(object):
         for w, client_model in zip(self.uploaded_weights, self.uploaded_models):
             self.add_parameters(w, client_model)
 
+    def aggregate_updates(self):
+        # global + sum_k w_k * delta_k, decoded straight into one flat buffer
+        flat = parameters_to_vector(self.global_model.parameters()).detach().clone()
+        for w, payload in zip(self.uploaded_weights, self.uploaded_updates):
+            self.uplink_codec.decode_into(payload, flat, w)
+        vector_to_parameters(flat, self.global_model.parameters())
+
+        # buffers (e.g. BN statistics) are taken from the first client, as in the model path
+        for server_buffer, client_buffer in zip(self.global_model.buffers(), self.uploaded_models[0].buffers()):
+            server_buffer.data.copy_(client_buffer.data)
+
     def add_parameters(self, w, client_model):
         for server_param, client_param in zip(self.global_model.parameters(), client_model.parameters()):
             server_param.data += client_param.data.clone() * w
 
+    def staleness_weight(self, staleness):
+        return (1 + staleness) ** (-self.async_staleness_exp)
+
+    def aggregate_buffer(self, buffer, codec):
+        """
+        FedBuff step: global += sum_i n_i * s(tau_i) * delta_i / sum_i n_i over the
+        buffered (payload, train samples, staleness) entries.
+        """
+        tot_samples = sum(n for _, n, _ in buffer)
+        flat = parameters_to_vector(self.global_model.parameters()).detach().clone()
+        for payload, n, staleness in buffer:
+            codec.decode_into(payload, flat, self.staleness_weight(staleness) * n / tot_samples)
+        vector_to_parameters(flat, self.global_model.parameters())
+
+    def dispatch_async(self, client, codec):
+        """ Send the current global model to an idle client, train it and schedule its arrival. """
+        client.set_parameters(self.deliver(client))
+        client.train()
+
+        global_flat = parameters_to_vector(self.global_model.parameters()).detach()
+        payload = codec.encode(client.id, parameters_to_vector(client.model.parameters()).detach() - global_flat)
+        arrival = self.simulator.clock + self.charge_round(client, payload_nbytes(payload))
+
+        self.async_busy.add(client.id)
+        heapq.heappush(self.async_events, (arrival, client.id, self.model_version, payload))
+
+    def train_async(self, task=0):
+        """
+        Buffered asynchronous training (FedBuff) on the simulated clock.
+
+        ``current_num_join_clients`` clients train concurrently, each from the global
+        version current when it was dispatched; a client that finishes is replaced
+        by a random idle one. Arrivals enter a buffer that is aggregated every
+        ``async_buffer_size`` updates by ``aggregate_buffer``. One aggregation counts
+        as one global round. Updates still in flight at the end are dropped.
+        Returns the global iteration of the last round.
+
+        A checkpoint is taken after an aggregation, when the buffer is empty; it
+        holds the in-flight updates, so a resumed task continues with them.
+        """
+        codec = self.uplink_codec
+        if codec is None:
+            codec = UplinkCodec([p.shape for p in self.global_model.parameters()])
+
+        glob_iter = self.global_rounds * task
+        if self.skip_round(task, self.global_rounds - 1):
+            return glob_iter + self.global_rounds - 1
+
+        i = 0
+        if self.resume_point is not None and self.resume_point[0] == task and self.resume_point[1] > 0:
+            # async_events and async_busy were restored with the checkpoint
+            i = self.resume_point[1]
+            glob_iter = i - 1 + self.global_rounds * task
+            self.publish_global()
+        else:
+            self.async_events = []
+            self.async_busy = set()
+            self.publish_global()
+            for client in self.select_clients():
+                self.dispatch_async(client, codec)
+
+        buffer = []
+        arrived_bytes = {}
+        s_t = time.time()
+        while i < self.global_rounds and len(self.async_events) > 0:
+            arrival, cid, version, payload = heapq.heappop(self.async_events)
+            self.simulator.advance(arrival - self.simulator.clock)
+            self.async_busy.discard(cid)
+            buffer.append((payload, self.clients[cid].train_samples, self.model_version - version))
+            arrived_bytes[cid] = arrived_bytes.get(cid, 0) + payload_nbytes(payload)
+
+            aggregated = len(buffer) >= self.async_buffer_size
+            if aggregated:
+                self.aggregate_buffer(buffer, codec)
+                buffer = []
+                self.model_version += 1
+                self.rs_uplink_bytes.append(arrived_bytes)
+                arrived_bytes = {}
+                self.rs_sim_time.append(self.simulator.clock)
+                self.publish_global()
+
+                glob_iter = i + self.global_rounds * task
+                if i % self.eval_gap == 0:
+                    print(f"\n-------------Round number: {i} (simulated time {self.simulator.clock:.1f}s)-------------")
+                    print("\nEvaluate global model")
+                    self.evaluate(glob_iter=glob_iter)
+
+                self.Budget.append(time.time() - s_t)
+                print('-'*25, 'time cost', '-'*25, self.Budget[-1])
+                s_t = time.time()
+
+            idle = [c for c in self.clients if c.id not in self.async_busy]
+            if len(idle) > 0:
+                self.dispatch_async(idle[np.random.randint(len(idle))], codec)
+
+            if aggregated:
+                # after the dispatch, so the checkpoint holds every update in flight
+                self.save_checkpoint(task, i)
+                i += 1
+                if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
+                    break
+
+        return glob_iter
+
+    def checkpoint_state(self):
+        return {
+            'global_model': self.global_model.state_dict(),
+            'current_task': self.current_task,
+            'task_dict': self.task_dict,
+            'model_version': self.model_version,
+            'clock': self.simulator.clock,
+            'samples_seen': self.simulator.samples_seen,
+            'history': {name: value.state_dict() if isinstance(value, MetricHistory) else value
+                        for name, value in vars(self).items() if name.startswith('rs_') or name == 'Budget'},
+            'metrics_lengths': None if self.metrics is None else self.metrics.lengths(),
+            'async_events': self.async_events,
+            'async_busy': self.async_busy,
+        }
+
+    def load_checkpoint_state(self, state):
+        self.global_model.load_state_dict(state['global_model'])
+        self.current_task = state['current_task']
+        self.task_dict = state['task_dict']
+        self.model_version = state['model_version']
+        self.simulator.clock = state['clock']
+        self.simulator.samples_seen = state['samples_seen']
+        for name, value in state['history'].items():
+            if isinstance(getattr(self, name, None), MetricHistory):
+                getattr(self, name).load_state_dict(value)
+            else:
+                setattr(self, name, value)
+        if self.metrics is not None and state['metrics_lengths'] is not None:
+            self.metrics.truncate(state['metrics_lengths'])
+        self.async_events = to_device(state.get('async_events', []), self.device)
+        self.async_busy = set(state.get('async_busy', ()))
+
+    def resume_checkpoint(self):
+        """
+        With --resume, restore the server from its last checkpoint. The task loop
+        still replays the (cheap) data and label set-up of earlier tasks, while
+        skip_round skips every round before the checkpointed one. restore_clients
+        then restores the clients, and the server state the replay touched, once
+        the checkpointed task is set up.
+        """
+        if not self.args.resume or not self.checkpointer.exists():
+            return
+        self.resume_state = self.checkpointer.load_server()
+        self.load_checkpoint_state(self.resume_state['server'])
+        self.resume_point = (self.resume_state['task'], self.resume_state['round'])
+        print("Resuming from task {}, round {}".format(*self.resume_point))
+
+    def restore_clients(self, task):
+        if self.resume_state is None or task != self.resume_state['task']:
+            return
+        self.load_checkpoint_state(self.resume_state['server'])
+        self.checkpointer.restore_clients(self, self.resume_state)
+        self.resume_state = None
+
+    def skip_round(self, task, i):
+        return self.resume_point is not None and (task, i) < self.resume_point
+
+    def save_checkpoint(self, task, i):
+        if self.checkpointer is not None and self.checkpointer.due(i + self.global_rounds * task):
+            self.checkpointer.save(self, task, i + 1)
+
     def save_global_model(self):
         model_path = os.path.join("models", self.dataset)
         if not os.path.exists(model_path):
@@ -223,7 +517,18 @@ class Server(object):
         model_path = os.path.join(model_path, self.algorithm + "_server" + ".pt")
         return os.path.exists(model_path)
         
+    def results_path(self):
+        return "../results/{}_{}_{}_{}.h5".format(self.dataset, self.algorithm, self.goal, self.times)
+
     def save_results(self):
+        if self.checkpointer is not None:
+            # the last checkpoint is written in the background
+            self.checkpointer.wait()
+        if self.metrics is not None:
+            self.metrics.close()
+            print("File path: " + self.metrics.file_path)
+            return
+
         algo = self.dataset + "_" + self.algorithm
         result_path = "../results/"
         if not os.path.exists(result_path):
@@ -234,6 +539,7 @@ class Server(object):
             file_path = result_path + "{}.h5".format(algo)
             print("File path: " + file_path)
 
+            import h5py
             with h5py.File(file_path, 'w') as hf:
                 hf.create_dataset('rs_test_acc', data=self.rs_test_acc)
                 hf.create_dataset('rs_test_auc', data=self.rs_test_auc)
@@ -293,6 +599,11 @@ class Server(object):
         
         if acc == None:
             self.rs_test_acc.append(test_acc)
+            self.rs_eval_sim_time.append(self.simulator.clock)
+            if self.metrics is not None:
+                self.metrics.extend('client_round', [glob_iter] * len(stats[0]))
+                self.metrics.extend('client_id', stats[0])
+                self.metrics.extend('client_test_acc', accs)
         else:
             acc.append(test_acc)
         
@@ -302,6 +613,7 @@ class Server(object):
             loss.append(train_loss)
 
         if self.args.wandb:
+            import wandb
             wandb.log({
                 "Global/Averaged Train Loss": train_loss,
                 "Global/Averaged Test Accurancy": test_acc,
@@ -322,17 +634,24 @@ class Server(object):
         print("Average Test AUC: {:.4f}".format(test_auc))
         print("Average Train Loss: {:.4f}".format(train_loss))
 
+    @staticmethod
+    def since_best(acc_ls):
+        # rounds since the best value ever, also when older values left the window
+        if isinstance(acc_ls, MetricHistory):
+            return acc_ls.count - acc_ls.best_index
+        return len(acc_ls) - torch.topk(torch.tensor(acc_ls), 1).indices[0]
+
     def check_done(self, acc_lss, top_cnt=None, div_value=None):
         for acc_ls in acc_lss:
             if top_cnt is not None and div_value is not None:
-                find_top = len(acc_ls) - torch.topk(torch.tensor(acc_ls), 1).indices[0] > top_cnt
+                find_top = self.since_best(acc_ls) > top_cnt
                 find_div = len(acc_ls) > 1 and np.std(acc_ls[-top_cnt:]) < div_value
                 if find_top and find_div:
                     pass
                 else:
                     return False
             elif top_cnt is not None:
-                find_top = len(acc_ls) - torch.topk(torch.tensor(acc_ls), 1).indices[0] > top_cnt
+                find_top = self.since_best(acc_ls) > top_cnt
                 if find_top:
                     pass
                 else:
@@ -348,6 +667,7 @@ class Server(object):
         return True
 
     def call_dlg(self, R):
+        from utils.dlg import DLG
         # items = []
         cnt = 0
         psnr_val = 0
@@ -395,7 +715,8 @@ class Server(object):
                             train_samples=len(train_data), 
                             test_samples=len(test_data), 
                             train_slow=False, 
-                            send_slow=False)
+                            send_slow=False,
+                            times=self.times)
             self.new_clients.append(client)
 
     # fine-tuning on new clients
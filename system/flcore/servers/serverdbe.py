@@ -11,11 +11,10 @@ class FedDBE(Server):
         # select slow clients
         self.set_slow_clients()
 
-        # initialization period
+        # initialization period: collect running means only, on the shared client executor
         self.set_clients(clientDBE)
         self.selected_clients = self.clients
-        for client in self.selected_clients:
-            client.train() # no DBE
+        self.run_clients(lambda client: client.warmup(), self.selected_clients)
 
         self.uploaded_ids = []
         self.uploaded_weights = []
@@ -29,22 +28,27 @@ class FedDBE(Server):
             
         global_mean = 0
         for cid, w in zip(self.uploaded_ids, self.uploaded_weights):
-            global_mean += self.clients[cid].running_mean * w
+            global_mean += self.clients[cid].dbe.running_mean * w
         print('>>>> global_mean <<<<', global_mean)
         for client in self.selected_clients:
-            client.global_mean = global_mean.data.clone()
+            client.dbe.global_mean = global_mean.data.clone()
 
         print(f"\nJoin ratio / total clients: {self.join_ratio} / {self.num_clients}")
         print("Finished creating server and clients.")
 
         # self.load_model()
         self.Budget = []
-        print('featrue map shape: ', self.clients[0].client_mean.shape)
-        print('featrue map numel: ', self.clients[0].client_mean.numel())
+        print('featrue map shape: ', self.clients[0].dbe.client_mean.shape)
+        print('featrue map numel: ', self.clients[0].dbe.client_mean.numel())
 
 
     def train(self):
+        self.resume_checkpoint()
+        self.restore_clients(0)
+
         for i in range(self.global_rounds+1):
+            if self.skip_round(0, i):
+                continue
             s_t = time.time()
             self.selected_clients = self.select_clients()
             self.send_models()
@@ -52,7 +56,7 @@ class FedDBE(Server):
             if i%self.eval_gap == 0:
                 print(f"\n-------------Round number: {i}-------------")
                 print("\nEvaluate model")
-                self.evaluate()
+                self.evaluate(glob_iter=i)
 
             for client in self.selected_clients:
                 client.train()
@@ -67,12 +71,13 @@ class FedDBE(Server):
 
             self.Budget.append(time.time() - s_t)
             print('-'*25, 'time cost', '-'*25, self.Budget[-1])
+            self.save_checkpoint(0, i)
 
             if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
                 break
 
         print("\nBest accuracy.")
-        print(max(self.rs_test_acc))
+        print(self.rs_test_acc.best)
         print("\nAverage time cost per round.")
         print(sum(self.Budget[1:])/len(self.Budget[1:]))
 
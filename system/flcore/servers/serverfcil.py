@@ -11,8 +11,7 @@ from threading import Thread
 from utils.model_utils import read_client_data_FCL, read_client_data_FCL_imagenet1k
 from utils.data_utils import get_unique_tasks
 from flcore.trainmodel.models import LeNet2, weights_init
-from flcore.utils.fcil_utils import Proxy_Data
-from torchvision import transforms
+from flcore.utils.snapshot_utils import ModelSnapshots
 
 
 class FedFCIL(Server):
@@ -30,13 +29,20 @@ class FedFCIL(Server):
         self.Budget = []
 
         self.pool_grad = None
-        self.best_model_1 = None
-        self.best_model_2 = None
+        # best_version_1 and best_version_2 are held while a new version is saved
+        if args.max_snapshots < 3:
+            raise ValueError("max_snapshots must be at least 3, got {}".format(args.max_snapshots))
+        self.snapshots = ModelSnapshots(max_snapshots=args.max_snapshots)
+        self.best_version_1 = None
+        self.best_version_2 = None
         self.best_perf = 0
 
         self.unique_task = []
         self.old_unique_task = []
 
+        self.proxy_images = None
+        self.proxy_labels = None
+
         self.encode_model = LeNet2(num_classes=self.num_classes)
         self.encode_model.apply(weights_init)
 
@@ -49,6 +55,7 @@ class FedFCIL(Server):
         else:
             N_TASKS = len(self.data['train_data'][self.data['client_names'][0]]['x'])
         print(str(N_TASKS) + " tasks are available")
+        self.resume_checkpoint()
 
         """
             Init for parameters for learning FCIL 
@@ -121,12 +128,15 @@ class FedFCIL(Server):
             self.unique_task = get_unique_tasks(task_list)
             self.assign_unique_tasks()
             # print(f"task_dict: {self.task_dict}")
+            self.restore_clients(task)
             for u in self.clients:
                 u.assign_task_id(self.task_dict)
 
             for i in range(self.global_rounds):
 
                 glob_iter = i + self.global_rounds * task
+                if self.skip_round(task, i):
+                    continue
                 s_t = time.time()
                 """
                     L85-L103 FCIL/fl_main.py
@@ -155,7 +165,7 @@ class FedFCIL(Server):
                         client.beforeTrain(task_id, 0)
                     else:
                         client.beforeTrain(task_id, 1)
-                    client.update_new_set()
+                    client.update_new_set(ep_g)
                     client.train(ep_g, model_old)
                     local_model = client.model.state_dict()
                     proto_grad = client.proto_grad_sharing()
@@ -176,7 +186,6 @@ class FedFCIL(Server):
                 if self.dlg_eval and i % self.dlg_gap == 0:
                     self.call_dlg(i)
 
-                w_g_last = copy.deepcopy(self.global_model)
                 self.aggregate_parameters()
                 """
                     - Aggregate parameters returns self.global_model (w_g_new)
@@ -185,6 +194,7 @@ class FedFCIL(Server):
 
                 self.Budget.append(time.time() - s_t)
                 print('-' * 25, 'time cost', '-' * 25, self.Budget[-1])
+                self.save_checkpoint(task, i)
 
                 if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
                     break
@@ -192,7 +202,7 @@ class FedFCIL(Server):
             print("\nBest accuracy.")
             # self.print_(max(self.rs_test_acc), max(
             #     self.rs_train_acc), min(self.rs_train_loss))
-            print(max(self.rs_test_acc))
+            print(self.rs_test_acc.best)
             print("\nAverage time cost per round.")
             print(sum(self.Budget[1:]) / len(self.Budget[1:]))
 
@@ -206,40 +216,63 @@ class FedFCIL(Server):
                 print("\nEvaluate new clients")
                 self.evaluate(glob_iter=glob_iter)
 
+    def checkpoint_state(self):
+        state = super().checkpoint_state()
+        state.update({
+            'snapshots': self.snapshots.state_dict(),
+            'best_version_1': self.best_version_1,
+            'best_version_2': self.best_version_2,
+            'best_perf': self.best_perf,
+            'unique_task': self.unique_task,
+            'old_unique_task': self.old_unique_task,
+            'proxy_images': self.proxy_images,
+            'proxy_labels': self.proxy_labels,
+        })
+        return state
+
+    def load_checkpoint_state(self, state):
+        super().load_checkpoint_state(state)
+        self.snapshots.load_state_dict(state['snapshots'], device=self.device)
+        self.best_version_1 = state['best_version_1']
+        self.best_version_2 = state['best_version_2']
+        self.best_perf = state['best_perf']
+        self.unique_task = state['unique_task']
+        self.old_unique_task = state['old_unique_task']
+        self.proxy_images = None if state['proxy_images'] is None else state['proxy_images'].to(self.device)
+        self.proxy_labels = None if state['proxy_labels'] is None else state['proxy_labels'].to(self.device)
+
     def model_back(self):
-        return [self.best_model_1, self.best_model_2]
+        return [self.snapshots.view(self.best_version_1, self.global_model),
+                self.snapshots.view(self.best_version_2, self.global_model)]
 
     def dataloader(self, pool_grad):
 
         self.pool_grad = pool_grad
         if len(pool_grad) != 0:
             self.reconstruction()
-            # Change with test_dataset here
-            self.monitor_dataset.getTestData(self.new_set, self.new_set_label)
-            self.monitor_loader = DataLoader(dataset=self.monitor_dataset, shuffle=True, batch_size=64, drop_last=True)
             self.last_perf = 0
-            self.best_model_1 = self.best_model_2
+            self.best_version_1 = self.best_version_2
 
         cur_perf = self.monitor()
         print(cur_perf)
         if cur_perf >= self.best_perf:
             self.best_perf = cur_perf
-            self.best_model_2 = copy.deepcopy(self.model)
+            self.best_version_2 = self.snapshots.save(self.global_model)
+        self.snapshots.retain([self.best_version_1, self.best_version_2])
 
     """
         Verify later
     """
-    def monitor(self):
+    def monitor(self, batch_size=256):
+        if self.proxy_images is None or len(self.proxy_labels) == 0:
+            return 0.
         self.global_model.eval()
-        correct, total = 0, 0
-        for step, (imgs, labels) in enumerate(self.monitor_loader):
-            imgs, labels = imgs.cuda(self.device), labels.cuda(self.device)
-            with torch.no_grad():
-                outputs = self.global_model(imgs)
-            predicts = torch.max(outputs, dim=1)[1]
-            correct += (predicts.cpu() == labels.cpu()).sum()
-            total += len(labels)
-        accuracy = 100 * correct / total
+        correct = torch.zeros((), dtype=torch.long, device=self.proxy_labels.device)
+        with torch.no_grad():
+            for start in range(0, len(self.proxy_labels), batch_size):
+                outputs = self.global_model(self.proxy_images[start:start + batch_size])
+                correct += (outputs.argmax(dim=1) == self.proxy_labels[start:start + batch_size]).sum()
+        accuracy = 100. * correct.item() / len(self.proxy_labels)
 
         return accuracy
 
@@ -252,11 +285,13 @@ class FedFCIL(Server):
         return pool_label
 
     def reconstruction(self):
+        """
+        Rebuild the proxy set from the shared prototype gradients. The images are
+        written straight into one preallocated device tensor, in the model's input
+        space, so monitoring needs no host round-trip.
+        """
         Iteration = 250
-        self.new_set, self.new_set_label = [], []
 
-        tt = transforms.Compose([transforms.ToTensor()])
-        tp = transforms.Compose([transforms.ToPILImage()])
         pool_label = self.gradient2label()
         pool_label = np.array(pool_label)
         # print(pool_label)
@@ -266,11 +301,11 @@ class FedFCIL(Server):
             class_ratio[0, i] += 1
 
         self.num_image = 20
+        self.proxy_images = torch.empty((len(pool_label) * self.num_image, 3, 32, 32), device=self.device)
+        self.proxy_labels = torch.empty(len(pool_label) * self.num_image, dtype=torch.long, device=self.device)
+        offset = 0
         for label_i in range(self.num_classes):
             if class_ratio[0, label_i] > 0:
-                num_augmentation = self.num_image
-                augmentation = []
-
                 grad_index = np.where(pool_label == label_i)
                 for j in range(len(grad_index[0])):
                     # print('reconstruct_{}, {}-th'.format(label_i, j))
@@ -305,8 +340,6 @@ class FedFCIL(Server):
                             print(current_loss)
 
                         if iters >= Iteration - self.num_image:
-                            dummy_data_temp = np.asarray(tp(dummy_data.clone().squeeze(0).cpu()))
-                            augmentation.append(dummy_data_temp)
-
-                self.new_set.append(augmentation)
-                self.new_set_label.append(label_i)
+                            self.proxy_images[offset] = dummy_data.detach().squeeze(0)
+                            self.proxy_labels[offset] = label_i
+                            offset += 1
@@ -38,6 +38,7 @@ class FedSTGM(Server):
         else:
             N_TASKS = len(self.data['train_data'][self.data['client_names'][0]]['x'])
         print(str(N_TASKS) + " tasks are available")
+        self.resume_checkpoint()
 
         for task in range(N_TASKS):
 
@@ -88,65 +89,80 @@ class FedSTGM(Server):
                     u.available_labels_current = list(available_labels_current)
                     u.available_labels_past = list(available_labels_past)
 
-            for i in range(self.global_rounds):
+            self.restore_clients(task)
 
-                glob_iter = i + self.global_rounds * task
-                s_t = time.time()
-                self.selected_clients = self.select_clients()
-                self.send_models()
-
-                if i % self.eval_gap == 0:
-                    print(f"\n-------------Round number: {i}-------------")
-                    print("\nEvaluate global model")
-                    self.evaluate(glob_iter=glob_iter)
-
-                for client in self.selected_clients:
-                    client.train()
-
-                # threads = [Thread(target=client.train)
-                #            for client in self.selected_clients]
-                # [t.start() for t in threads]
-                # [t.join() for t in threads]
-
-                self.receive_models()
-                self.receive_grads()
-
-                """
-                Add aggregate STGM
-                """
-                grad_ez = sum(p.numel() for p in self.global_model.parameters())
-                grads = torch.Tensor(grad_ez, self.num_clients)
+            if self.async_mode:
+                glob_iter = self.train_async(task)
+            else:
+                for i in range(self.global_rounds):
+
+                    glob_iter = i + self.global_rounds * task
+                    if self.skip_round(task, i):
+                        continue
+                    s_t = time.time()
+                    self.selected_clients = self.select_clients()
+                    self.send_models()
+
+                    if i % self.eval_gap == 0:
+                        print(f"\n-------------Round number: {i}-------------")
+                        print("\nEvaluate global model")
+                        self.evaluate(glob_iter=glob_iter)
+
+                    for client in self.selected_clients:
+                        client.train()
+
+                    # threads = [Thread(target=client.train)
+                    #            for client in self.selected_clients]
+                    # [t.start() for t in threads]
+                    # [t.join() for t in threads]
+
+                    self.receive_models()
+
+                    """
+                    Add aggregate STGM
+                    """
+                    grad_ez = sum(p.numel() for p in self.global_model.parameters())
+                    if self.uploaded_updates:
+                        # decode the weighted updates straight into the rows of the gradient matrix
+                        grads = torch.zeros(self.num_clients, grad_ez, device=self.device)
+                        for index, (w, payload) in enumerate(zip(self.uploaded_weights, self.uploaded_updates)):
+                            self.uplink_codec.decode_into(payload, grads[index], w)
+                        grads = grads.t()
+                    else:
+                        self.receive_grads()
+                        grads = torch.zeros(grad_ez, self.num_clients)
 
-                for index, model in enumerate(self.grads):
-                    grad2vec2(model, grads, index)
+                        for index, model in enumerate(self.grads):
+                            grad2vec2(model, grads, index)
 
-                g = self.aggregate_stgm(grads, self.num_clients)
+                    g = self.aggregate_stgm(grads, self.num_clients)
 
-                # model_origin = copy.deepcopy(self.global_model)
-                self.overwrite_grad2(self.global_model, g)
-                for param in self.global_model.parameters():
-                    param.data += param.grad
+                    # model_origin = copy.deepcopy(self.global_model)
+                    self.overwrite_grad2(self.global_model, g)
+                    for param in self.global_model.parameters():
+                        param.data += param.grad
 
-                # angle = [self.cos_sim(model_origin, self.global_model, models) for models in self.grads]
-                # self.angle_value = statistics.mean(angle)
-                #
-                # angle_value = []
-                # for i in self.grads:
-                #     for j in self.grads:
-                #         angle_value = [self.cosine_similarity(i, j)]
-                #
-                # self.grads_angle_value = statistics.mean(angle_value)
+                    # angle = [self.cos_sim(model_origin, self.global_model, models) for models in self.grads]
+                    # self.angle_value = statistics.mean(angle)
+                    #
+                    # angle_value = []
+                    # for i in self.grads:
+                    #     for j in self.grads:
+                    #         angle_value = [self.cosine_similarity(i, j)]
+                    #
+                    # self.grads_angle_value = statistics.mean(angle_value)
 
-                self.Budget.append(time.time() - s_t)
-                print('-' * 25, 'time cost', '-' * 25, self.Budget[-1])
+                    self.Budget.append(time.time() - s_t)
+                    print('-' * 25, 'time cost', '-' * 25, self.Budget[-1])
+                    self.save_checkpoint(task, i)
 
-                if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
-                    break
+                    if self.auto_break and self.check_done(acc_lss=[self.rs_test_acc], top_cnt=self.top_cnt):
+                        break
 
             print("\nBest accuracy.")
             # self.print_(max(self.rs_test_acc), max(
             #     self.rs_train_acc), min(self.rs_train_loss))
-            print(max(self.rs_test_acc))
+            print(self.rs_test_acc.best)
             print("\nAverage time cost per round.")
             print(sum(self.Budget[1:]) / len(self.Budget[1:]))
 
@@ -160,6 +176,23 @@ class FedSTGM(Server):
                 print("\nEvaluate new clients")
                 self.evaluate(glob_iter=glob_iter)
 
+    def aggregate_buffer(self, buffer, codec):
+        """
+        Asynchronous mode: STGM over the buffered updates, each row weighted by its
+        share of samples and its staleness as in the FedBuff step.
+        """
+        grad_ez = sum(p.numel() for p in self.global_model.parameters())
+        tot_samples = sum(n for _, n, _ in buffer)
+        grads = torch.zeros(len(buffer), grad_ez, device=self.device)
+        for index, (payload, n, staleness) in enumerate(buffer):
+            codec.decode_into(payload, grads[index], self.staleness_weight(staleness) * n / tot_samples)
+
+        g = self.aggregate_stgm(grads.t(), len(buffer))
+        for param in self.global_model.parameters():
+            num_elements = param.numel()
+            param.data += (g[:num_elements] * len(buffer)).view(param.data.size())
+            g = g[num_elements:]
+
     def aggregate_stgm(self, grad_vec, num_tasks):
 
         grads = grad_vec.to(self.device)
@@ -1,18 +1,18 @@
 import time
 import torch
-from flcore.clients.clientavg import clientAVG
+from flcore.clients.clientweit import clientweit
 from flcore.servers.serverbase import Server
 from threading import Thread
 from utils.model_utils import read_client_data_FCL, read_client_data_FCL_imagenet1k
 
 
-class FedAvg(Server):
+class FedWeIT(Server):
     def __init__(self, args, times):
         super().__init__(args, times)
 
         # select slow clients
         self.set_slow_clients()
-        self.set_clients(clientAVG)
+        self.set_clients(clientweit)
 
         print(f"\nJoin ratio / total clients: {self.join_ratio} / {self.num_clients}")
         print("Finished creating server and clients.")
@@ -108,7 +108,7 @@ class FedAvg(Server):
             print("\nBest accuracy.")
             # self.print_(max(self.rs_test_acc), max(
             #     self.rs_train_acc), min(self.rs_train_loss))
-            print(max(self.rs_test_acc))
+            print(self.rs_test_acc.best)
             print("\nAverage time cost per round.")
             print(sum(self.Budget[1:])/len(self.Budget[1:]))
 
@@ -117,7 +117,7 @@ class FedAvg(Server):
 
             if self.num_new_clients > 0:
                 self.eval_new_clients = True
-                self.set_new_clients(clientAVG)
+                self.set_new_clients(clientweit)
                 print(f"\n-------------Fine tuning round-------------")
                 print("\nEvaluate new clients")
                 self.evaluate(glob_iter=glob_iter)
@@ -1,9 +1,11 @@
+import os
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
-from utils.fedweit_utils import *
+from flcore.utils.fedweit_utils import *
 
 class NetModule:
     """ This module manages model networks and parameters
@@ -135,19 +137,31 @@ class NetModule:
                 trainable = False
                 init_value = np.zeros(shape).astype(np.float32)
             else:
-                init_value = self.initializer(torch.empty(shape)).numpy()
+                init_value = self.init_vector(shape)
         elif var_type == 'from_kb':
-            shape = np.concatenate([self.shapes[lid], [int(round(self.args.num_clients*self.args.frac_clients))]], axis=0)
+            shape = tuple(self.shapes[lid]) + (int(round(self.args.num_clients*self.args.frac_clients)),)
             trainable = False
             if tid == 0:
                 init_value = np.zeros(shape).astype(np.float32)
             else:
                 init_value = self.initializer(torch.empty(shape)).numpy()
+        elif var_type == 'mask' and len(self.shapes[lid]) == 4:
+            # one mask value per output channel, broadcast over the (out, in, kh, kw) kernel
+            init_value = self.init_vector((self.shapes[lid][0],)).reshape(-1, 1, 1, 1)
         else:
-            init_value = self.initializer(torch.empty(self.shapes[lid][-1],)).numpy()
+            init_value = self.init_vector((self.out_features(lid),))
         var = torch.nn.Parameter(torch.tensor(init_value), requires_grad=trainable)
         self.decomposed_variables[var_type][tid][lid] = var
 
+    def out_features(self, lid):
+        # conv kernels are (out, in, kh, kw), dense weights (in, out)
+        shape = self.shapes[lid]
+        return shape[0] if len(shape) == 4 else shape[-1]
+
+    def init_vector(self, shape):
+        # kaiming normal with fan_in = length, since kaiming_normal_ needs 2-D tensors
+        return np.random.normal(0., math.sqrt(2. / shape[0]), shape).astype(np.float32)
+
     def get_variable(self, var_type, lid, tid=None):
         if var_type == 'shared':
             return self.decomposed_variables[var_type][lid]
@@ -231,7 +245,7 @@ class NetModule:
                 dlay.aw_kb = self.get_variable('from_kb', lid, tid) 
 
     def add_head(self, body):
-        head = nn.Linear(body.output_shape[1], self.args.num_classes)
+        head = nn.Linear(self.shapes[-1][-1], self.args.num_classes)
         self.heads.append(head)
         self.initial_heads_weights.append(head.state_dict())
         return nn.Sequential(body, head) # multiheaded model
@@ -266,8 +280,8 @@ class NetModule:
                     lid, tid,
                     units=self.shapes[lid][-1],
                     acti='relu')
-            layers.append(self.decomposed_layers[self.lid])
-            self.lid += 1
+                layers.append(self.decomposed_layers[self.lid])
+                self.lid += 1
             model = nn.Sequential(*layers)
         else:
             layers = []
@@ -287,12 +301,11 @@ class NetModule:
 
     def conv_decomposed(self, lid, tid, filters, kernel_size, strides, padding, acti):
         return  DecomposedConv(
-            name        = 'layer_{}'.format(lid),
             filters     = filters,
             kernel_size = kernel_size,
             strides     = strides,
             padding     = padding,
-            activation  = acti,
+            activation  = getattr(F, acti) if acti else None,
             lambda_l1   = self.args.lambda_l1,
             lambda_mask = self.args.lambda_mask,
             shared      = self.get_variable('shared', lid),
@@ -300,13 +313,11 @@ class NetModule:
             from_kb     = self.get_variable('from_kb', lid, tid),
             atten       = self.get_variable('atten', lid, tid),
             bias        = self.get_variable('bias', lid, tid), use_bias=True,
-            mask        = self.generate_mask(self.get_variable('mask', lid, tid)),
-            kernel_regularizer = nn.L2(self.args.wd))
+            mask        = self.generate_mask(self.get_variable('mask', lid, tid)))
 
     def dense_decomposed(self, lid, tid, units, acti):
         return DecomposedDense(
-            name        = 'layer_{}'.format(lid),
-            activation  = acti,
+            activation  = getattr(F, acti) if acti else None,
             units       = units,
             lambda_l1   = self.args.lambda_l1,
             lambda_mask = self.args.lambda_mask,
@@ -315,8 +326,7 @@ class NetModule:
             from_kb     = self.get_variable('from_kb', lid, tid),
             atten       = self.get_variable('atten', lid, tid),
             bias        = self.get_variable('bias', lid, tid), use_bias=True,
-            mask        = self.generate_mask(self.get_variable('mask', lid, tid)),
-            kernel_regularizer = nn.L2(self.args.wd))
+            mask        = self.generate_mask(self.get_variable('mask', lid, tid)))
 
 # Layers
 class DecomposedDense(nn.Module):
@@ -0,0 +1,153 @@
+import os
+import copy
+import random
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+def atomic_save(obj, path):
+    """ ``torch.save`` to a temporary file, then rename it over ``path``. """
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_file(path):
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:  # torch < 1.13 has no weights_only
+        return torch.load(path, map_location='cpu')
+
+
+def detached_copy(obj):
+    """ Copy of a state tree with every tensor detached onto the CPU, safe to write from another thread. """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, np.ndarray):
+        return np.array(obj)
+    if isinstance(obj, dict):
+        return type(obj)((k, detached_copy(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(detached_copy(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def to_device(obj, device):
+    """ A state tree with every tensor moved to ``device``. """
+    if torch.is_tensor(obj):
+        return obj.to(device)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_device(v, device)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(v, device) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer():
+    """ Periodic, atomic and incremental checkpoints of a server and its clients.
+
+    Layout of ``ckpt_dir``:
+        server.pt: server state (``Server.checkpoint_state``), task and round to
+            resume from, RNG states and the client file of every client.
+        client_<id>_<step>.pt: state of one client (``Client.checkpoint_state``).
+
+    A client file is only rewritten when ``Client.checkpoint_fingerprint`` changed
+    since it was last written. States are copied to the CPU on the caller's
+    thread and written by one background thread; every file is written under a
+    temporary name and renamed, and ``server.pt`` is replaced last, so a crash
+    at any point leaves the previous checkpoint intact.
+
+    Args:
+        ckpt_dir: Directory of the checkpoint.
+        gap: Save every ``gap`` global iterations; 0 disables periodic saving.
+    """
+    def __init__(self, ckpt_dir, gap=1):
+        self.ckpt_dir = ckpt_dir
+        self.gap = gap
+        self.step = 0
+        self.fingerprints = {}  # cid -> fingerprint of the written state
+        self.client_files = {}  # cid -> file name
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    @property
+    def server_path(self):
+        return os.path.join(self.ckpt_dir, 'server.pt')
+
+    def exists(self):
+        return os.path.exists(self.server_path)
+
+    def due(self, glob_iter):
+        return self.gap > 0 and (glob_iter + 1) % self.gap == 0
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def save(self, server, task, round):
+        self.wait()
+        self.step += 1
+
+        client_states = {}
+        for client in server.clients:
+            fingerprint = client.checkpoint_fingerprint()
+            if self.fingerprints.get(client.id) != fingerprint or client.id not in self.client_files:
+                client_states[client.id] = detached_copy(client.checkpoint_state())
+                self.fingerprints[client.id] = fingerprint
+                self.client_files[client.id] = 'client_{}_{}.pt'.format(client.id, self.step)
+
+        state = {
+            'server': detached_copy(server.checkpoint_state()),
+            'task': task,
+            'round': round,
+            'rng': rng_state(),
+            'client_files': dict(self.client_files),
+        }
+        self.pending = self.executor.submit(self._write, state, client_states)
+
+    def _write(self, state, client_states):
+        if not os.path.exists(self.ckpt_dir):
+            os.makedirs(self.ckpt_dir)
+        for cid, client_state in client_states.items():
+            atomic_save(client_state, os.path.join(self.ckpt_dir, state['client_files'][cid]))
+        atomic_save(state, self.server_path)
+
+        # client files no longer referenced by server.pt
+        referenced = set(state['client_files'].values())
+        for name in os.listdir(self.ckpt_dir):
+            if name.startswith('client_') and name.endswith('.pt') and name not in referenced:
+                os.remove(os.path.join(self.ckpt_dir, name))
+
+    def load_server(self):
+        state = load_file(self.server_path)
+        self.client_files = dict(state['client_files'])
+        self.step = max([int(name[:-3].split('_')[-1]) for name in self.client_files.values()] + [0])
+        return state
+
+    def restore_clients(self, server, state):
+        for client in server.clients:
+            if client.id in self.client_files:
+                client.load_checkpoint_state(load_file(os.path.join(self.ckpt_dir, self.client_files[client.id])))
+                self.fingerprints[client.id] = client.checkpoint_fingerprint()
+        set_rng_state(state['rng'])
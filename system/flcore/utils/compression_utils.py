@@ -0,0 +1,239 @@
+import math
+import torch
+from collections import OrderedDict
+from torch.nn.utils import parameters_to_vector
+
+
+def payload_nbytes(payload):
+    """ Exact size of an encoded update: the bytes of every tensor it holds. """
+    if torch.is_tensor(payload):
+        return payload.nelement() * payload.element_size()
+    if isinstance(payload, dict):
+        return sum(payload_nbytes(v) for v in payload.values())
+    if isinstance(payload, (list, tuple)):
+        return sum(payload_nbytes(v) for v in payload)
+    return 0
+
+
+class UplinkCodec():
+    """ Encodes the flat update (client weights - global weights) a client uploads.
+
+    ``encode`` returns a payload made of tensors only, so its size on the wire is
+    ``payload_nbytes(payload)``. ``decode_into`` adds ``weight * update`` to a flat
+    buffer in place, which lets the aggregators skip materialising client models.
+
+    Args:
+        shapes: Shapes of the model parameters, in ``parameters()`` order.
+    """
+    name = 'identity'
+
+    def __init__(self, shapes):
+        self.shapes = [torch.Size(s) for s in shapes]
+        self.numel = sum(s.numel() for s in self.shapes)
+
+    def encode(self, cid, delta):
+        return {'values': delta.detach().clone()}
+
+    def decode_into(self, payload, out, weight=1.):
+        out.add_(payload['values'], alpha=weight)
+        return out
+
+
+class TopKCodec(UplinkCodec):
+    """ Keeps the ``ratio`` largest-magnitude entries. What is dropped is kept in a
+    per-client residual and added back before the next selection (error feedback),
+    unless ``error_feedback`` is off because the caller tracks residuals itself.
+    """
+    name = 'topk'
+
+    def __init__(self, shapes, ratio=0.01, error_feedback=True):
+        super().__init__(shapes)
+        self.k = max(1, int(math.ceil(ratio * self.numel)))
+        self.error_feedback = error_feedback
+        self.residuals = {}
+
+    def encode(self, cid, delta):
+        acc = delta.detach()
+        if cid in self.residuals:
+            acc = acc + self.residuals[cid]
+        elif self.error_feedback:
+            acc = acc.clone()
+
+        indices = acc.abs().topk(self.k, sorted=False).indices
+        values = acc[indices]
+        if self.error_feedback:
+            acc[indices] = 0
+            self.residuals[cid] = acc
+
+        index_dtype = torch.int32 if self.numel < 2 ** 31 else torch.int64
+        return {'indices': indices.to(index_dtype), 'values': values}
+
+    def decode_into(self, payload, out, weight=1.):
+        out.index_add_(0, payload['indices'].long(), payload['values'], alpha=weight)
+        return out
+
+
+class QuantizeCodec(UplinkCodec):
+    """ Unbiased stochastic quantization to ``bits`` (8 or 4) with one float scale per
+    bucket of ``bucket_size`` entries. 4-bit codes are packed two per byte.
+    """
+    def __init__(self, shapes, bits=8, bucket_size=512):
+        super().__init__(shapes)
+        assert bits in (4, 8)
+        self.bits = bits
+        self.name = 'q{}'.format(bits)
+        self.levels = 2 ** (bits - 1) - 1
+        self.bucket_size = bucket_size
+
+    def encode(self, cid, delta):
+        x = delta.detach()
+        pad = -x.numel() % self.bucket_size
+        if pad:
+            x = torch.cat([x, x.new_zeros(pad)])
+        x = x.view(-1, self.bucket_size)
+
+        scales = x.abs().amax(dim=1, keepdim=True).clamp_min(1e-12) / self.levels
+        codes = torch.floor(x / scales + torch.rand_like(x)).clamp_(-self.levels, self.levels)
+
+        if self.bits == 8:
+            codes = codes.to(torch.int8)
+        else:
+            codes = (codes + self.levels).to(torch.uint8).view(-1, 2)
+            codes = codes[:, 0] | (codes[:, 1] << 4)
+        return {'codes': codes, 'scales': scales.view(-1)}
+
+    def decode_into(self, payload, out, weight=1.):
+        codes = payload['codes']
+        if self.bits == 4:
+            codes = torch.stack([codes & 0xF, codes >> 4], dim=1).view(-1).to(torch.int8) - self.levels
+        values = codes.view(-1, self.bucket_size).to(out.dtype) * payload['scales'].view(-1, 1)
+        out.add_(values.view(-1)[:out.numel()], alpha=weight)
+        return out
+
+
+class LowRankCodec(UplinkCodec):
+    """ Sends each matrix-shaped parameter update (reshaped to rows x rest) as a
+    rank-``rank`` factorisation from ``torch.svd_lowrank``; vectors and parameters
+    too small to gain from it are sent as they are.
+    """
+    name = 'lowrank'
+
+    def __init__(self, shapes, rank=4, niter=2):
+        super().__init__(shapes)
+        self.rank = rank
+        self.niter = niter
+
+    def _factorized(self, shape):
+        if len(shape) < 2:
+            return False
+        rows, cols = shape[0], shape.numel() // shape[0]
+        return self.rank * (rows + cols) < rows * cols
+
+    def encode(self, cid, delta):
+        delta = delta.detach()
+        segments = []
+        offset = 0
+        for shape in self.shapes:
+            n = shape.numel()
+            segment = delta[offset:offset + n]
+            if self._factorized(shape):
+                U, S, V = torch.svd_lowrank(segment.view(shape[0], -1), q=self.rank, niter=self.niter)
+                segments.append({'us': U * S, 'v': V})
+            else:
+                segments.append({'values': segment.clone()})
+            offset += n
+        return {'segments': segments}
+
+    def decode_into(self, payload, out, weight=1.):
+        offset = 0
+        for shape, segment in zip(self.shapes, payload['segments']):
+            n = shape.numel()
+            if 'values' in segment:
+                out[offset:offset + n].add_(segment['values'], alpha=weight)
+            else:
+                out[offset:offset + n].view(shape[0], -1).addmm_(segment['us'], segment['v'].t(), alpha=weight)
+            offset += n
+        return out
+
+
+class DownlinkBroadcaster():
+    """ Server-side version tracking for delta broadcasts of the global model.
+
+    ``publish`` records the current global weights as a new version (unless they
+    equal the last published ones) and keeps the last ``max_history`` versions. ``encode`` returns
+    what a client needs to catch up from the version it last received:
+
+        full: the whole flat model, when the client never received one or its
+            version has left the history.
+        delta: the codec-encoded difference to the current version. The part a
+            lossy codec drops is kept per client and sent with the next delta.
+        none: nothing, the client is up to date.
+    """
+    def __init__(self, codec, max_history=5):
+        self.codec = codec
+        self.max_history = max_history
+        self.history = OrderedDict()  # version -> flat weights
+        self.version = -1
+        self.client_versions = {}
+        self.residuals = {}
+
+    def publish(self, model):
+        # compare contents: servers update the global model through ``.data``,
+        # which leaves the autograd version counter and storage pointer untouched
+        flat = parameters_to_vector(model.parameters()).detach()
+        if self.version in self.history and torch.equal(flat, self.history[self.version]):
+            return self.version
+        self.version += 1
+        self.history[self.version] = flat
+        while len(self.history) > self.max_history:
+            self.history.popitem(last=False)
+        return self.version
+
+    def encode(self, cid):
+        current = self.history[self.version]
+        base = self.client_versions.get(cid)
+        self.client_versions[cid] = self.version
+
+        if base is None or base not in self.history:
+            self.residuals.pop(cid, None)
+            return 'full', {'values': current}
+        if base == self.version and cid not in self.residuals:
+            return 'none', {}
+
+        needed = current - self.history[base]
+        if cid in self.residuals:
+            needed += self.residuals.pop(cid)
+        payload = self.codec.encode(cid, needed)
+        residual = needed.sub_(self.codec.decode_into(payload, torch.zeros_like(needed)))
+        if residual.any():
+            self.residuals[cid] = residual
+        return 'delta', payload
+
+
+def make_codec(codec, args, shapes, error_feedback=True):
+    if codec == 'identity':
+        return UplinkCodec(shapes)
+    if codec == 'topk':
+        return TopKCodec(shapes, ratio=args.topk_ratio, error_feedback=error_feedback)
+    if codec == 'q8':
+        return QuantizeCodec(shapes, bits=8)
+    if codec == 'q4':
+        return QuantizeCodec(shapes, bits=4)
+    if codec == 'lowrank':
+        return LowRankCodec(shapes, rank=args.lowrank_rank)
+    raise NotImplementedError(codec)
+
+
+def make_uplink_codec(args, shapes):
+    """ Codec selected by ``args.uplink_codec``, or None to upload models by reference. """
+    if args.uplink_codec == 'none':
+        return None
+    return make_codec(args.uplink_codec, args, shapes)
+
+
+def make_downlink(args, shapes):
+    """ Broadcaster for ``args.downlink_codec``, or None to send the full model every round. """
+    if args.downlink_codec == 'none':
+        return None
+    codec = make_codec(args.downlink_codec, args, shapes, error_feedback=False)
+    return DownlinkBroadcaster(codec, max_history=args.downlink_history)
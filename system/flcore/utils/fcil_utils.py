@@ -4,11 +4,11 @@ from torchvision import transforms
 import numpy as np
 from torch.nn import functional as F
 from PIL import Image
-import matplotlib.pyplot as plt
 from torch.autograd import Variable
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import random
+from collections import OrderedDict
 
 
 def get_one_hot(target, num_class, device):
@@ -22,6 +22,125 @@ def entropy(input_):
     entropy = torch.sum(entropy, dim=1)
     return entropy
 
+class IndexedDataset(torch.utils.data.Dataset):
+    """ Wraps a dataset so that each item also returns its index. """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        x, y = self.dataset[index]
+        return x, y, index
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class DistillCache():
+    """ Half-precision cache of the old model's sigmoid outputs, one row per training sample.
+
+    Rows are keyed by dataset index and the cache is tied to one ``key``
+    (task, old-model version); a different key drops every row. With random
+    train-time augmentation the cached target belongs to the view seen when
+    the row was filled.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.key = None
+        self.targets = None
+        self.filled = None
+
+    def prepare(self, key, num_samples):
+        if key == self.key and self.filled is not None and self.filled.numel() == num_samples:
+            return
+        self.key = key
+        self.targets = None
+        self.filled = torch.zeros(num_samples, dtype=torch.bool, device=self.device)
+
+    def lookup(self, index):
+        if self.targets is None or not bool(self.filled[index].all()):
+            return None
+        return self.targets[index].float()
+
+    def store(self, index, values):
+        if self.targets is None:
+            self.targets = torch.zeros(self.filled.numel(), values.size(1), dtype=torch.half, device=self.device)
+        self.targets[index] = values.half()
+        self.filled[index] = True
+
+
+class RunningEntropy():
+    """ Accumulates the mean prediction entropy on the device; syncs once on read. """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.total = None
+        self.count = 0
+
+    def update(self, logits):
+        ent = entropy(torch.softmax(logits.detach().float(), dim=1)).sum()
+        self.total = ent if self.total is None else self.total + ent
+        self.count += logits.size(0)
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return (self.total / self.count).item()
+
+
+def herding_selection(features, labels, classes, m):
+    """
+    Greedy herding (iCaRL) for several classes at once, kept on the device of ``features``.
+
+    Every class keeps a running sum of its picked features; samples already picked
+    are masked out, so each exemplar is unique. Distances use the expansion
+    ||mu - (S + f) / k||^2 = ||f||^2 / k^2 - 2 / k * (mu - S / k) . f + const,
+    which avoids materialising a (samples x dim) difference matrix per step.
+
+    Args:
+        features: (N, D) normalized features.
+        labels: (N,) labels of the rows of ``features``.
+        classes: Classes to build exemplar sets for.
+        m: Exemplars per class.
+
+    Returns:
+        A list with, per class, the row indices into ``features`` in herding order.
+    """
+    device = features.device
+    classes = torch.as_tensor([int(c) for c in classes], dtype=torch.long, device=device)
+    member = labels.view(1, -1) == classes.view(-1, 1)
+    counts = member.sum(dim=1)
+    counts_host = counts.tolist()
+    n_max = max(counts_host) if len(counts_host) > 0 else 0
+    m = min(m, n_max)
+    if m == 0:
+        return [torch.empty(0, dtype=torch.long, device=device) for _ in counts_host]
+
+    # row indices of each class first, padded with rows of other classes
+    order = torch.sort((~member).to(torch.int8), dim=1, stable=True).indices[:, :n_max]
+    valid = torch.arange(n_max, device=device).view(1, -1) < counts.view(-1, 1)
+    feats = features[order] * valid.unsqueeze(-1)
+    class_mean = feats.sum(dim=1) / counts.clamp(min=1).view(-1, 1).to(feats.dtype)
+    sq_norm = (feats * feats).sum(dim=-1)
+
+    rows = torch.arange(len(counts_host), device=device)
+    running = torch.zeros_like(class_mean)
+    available = valid.clone()
+    picks = torch.empty(len(counts_host), m, dtype=torch.long, device=device)
+    for i in range(m):
+        k = i + 1
+        residual = class_mean - running / k
+        dist = sq_norm / (k * k) - (2.0 / k) * torch.bmm(feats, residual.unsqueeze(-1)).squeeze(-1)
+        dist = dist.masked_fill(~available, float('inf'))
+        index = dist.argmin(dim=1)
+        picks[:, i] = index
+        available[rows, index] = False
+        running += feats[rows, index]
+
+    picks = order.gather(1, picks)
+    return [picks[c, :min(m, n)] for c, n in enumerate(counts_host)]
+
+
 class Proxy_Data():
     def __init__(self, test_transform=None):
         super(Proxy_Data, self).__init__()
@@ -30,12 +149,7 @@ class Proxy_Data():
         self.TestLabels = []
 
     def concatenate(self, datas, labels):
-        con_data = datas[0]
-        con_label = labels[0]
-        for i in range(1, len(datas)):
-            con_data = np.concatenate((con_data, datas[i]), axis=0)
-            con_label = np.concatenate((con_label,labels[i]), axis=0)
-        return con_data, con_label
+        return np.concatenate(datas, axis=0), np.concatenate(labels, axis=0)
 
     def getTestData(self, new_set, new_set_label):
         datas, labels = [], []
@@ -62,4 +176,167 @@ class Proxy_Data():
 
     def __len__(self):
         if self.TestData != []:
-            return self.TestData.shape[0]
\ No newline at end of file
+            return self.TestData.shape[0]
+
+class ExemplarMemory():
+    """ Fixed-budget exemplar store for class-incremental rehearsal.
+
+    Images, labels and features live in preallocated arrays of ``memory_size``
+    slots. Each class owns one contiguous slice, so per-class access is a dict
+    lookup plus a view, and shrinking the per-class quota compacts in place.
+
+    With ``quantize`` float images are stored as uint8 with a per-exemplar
+    offset and scale (a quarter of the float32 footprint, at most half a step
+    of error) and dequantized to their original dtype by ``get_class`` and
+    ``sample``. Integer images are stored as they are.
+
+    Args:
+        memory_size: Total number of exemplar slots.
+        mmap_path: If given, the image array is memory-mapped to this ``.npy`` file.
+        quantize: Store float images as uint8. Default: True
+    """
+    def __init__(self, memory_size, mmap_path=None, quantize=True):
+        self.memory_size = memory_size
+        self.mmap_path = mmap_path
+        self.quantize = quantize
+
+        self.images = None
+        self.image_dtype = None  # dtype images are returned in
+        self.offsets = None  # per-slot dequantization, None when stored as is
+        self.scales = None
+        self.features = None
+        self.labels = np.full(memory_size, -1, dtype=np.int64)
+        self.class_slices = OrderedDict()  # label -> (start, count)
+        self.size = 0
+        self.version = 0  # bumped on every change
+
+    def _allocate(self, shape, dtype, quantized, feature_dim=None):
+        self.image_dtype = np.dtype(dtype)
+        storage_dtype = np.uint8 if quantized else dtype
+        shape = (self.memory_size,) + tuple(shape)
+        if self.mmap_path is not None:
+            self.images = np.lib.format.open_memmap(self.mmap_path, mode='w+', dtype=storage_dtype, shape=shape)
+        else:
+            self.images = np.zeros(shape, dtype=storage_dtype)
+        if quantized:
+            self.offsets = np.zeros(self.memory_size, dtype=np.float32)
+            self.scales = np.zeros(self.memory_size, dtype=np.float32)
+        if feature_dim is not None:
+            self.features = np.zeros((self.memory_size, feature_dim), dtype=np.float32)
+
+    @staticmethod
+    def _quantize(images):
+        flat = images.reshape(len(images), -1).astype(np.float32)
+        offsets = flat.min(axis=1)
+        scales = (flat.max(axis=1) - offsets) / 255.
+        q = np.rint((flat - offsets[:, None]) / np.maximum(scales, 1e-12)[:, None])
+        return q.astype(np.uint8).reshape(images.shape), offsets, scales
+
+    def _read(self, index):
+        """ Images of the slots ``index`` (a slice or an index array) in their original dtype. """
+        images = self.images[index]
+        if self.scales is None:
+            return images
+        shape = (-1,) + (1,) * (images.ndim - 1)
+        images = images * self.scales[index].reshape(shape) + self.offsets[index].reshape(shape)
+        return images.astype(self.image_dtype, copy=False)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def classes(self):
+        return list(self.class_slices.keys())
+
+    def reduce(self, m):
+        """ Keep at most ``m`` exemplars per class and compact the slots. """
+        offset = 0
+        for label, (start, count) in self.class_slices.items():
+            count = min(count, m)
+            if start != offset:
+                self.images[offset:offset + count] = self.images[start:start + count]
+                self.labels[offset:offset + count] = self.labels[start:start + count]
+                if self.scales is not None:
+                    self.offsets[offset:offset + count] = self.offsets[start:start + count]
+                    self.scales[offset:offset + count] = self.scales[start:start + count]
+                if self.features is not None:
+                    self.features[offset:offset + count] = self.features[start:start + count]
+            self.class_slices[label] = (offset, count)
+            offset += count
+        self.labels[offset:self.size] = -1
+        self.size = offset
+        self.version += 1
+
+    def add_class(self, label, images, features=None):
+        """ Append the exemplars of one class, truncated to the free slots. """
+        images = np.asarray(images)
+        if self.images is None:
+            self._allocate(images.shape[1:], images.dtype, self.quantize and images.dtype.kind == 'f',
+                           None if features is None else features.shape[1])
+        if label in self.class_slices:
+            raise ValueError("class {} is already stored".format(label))
+
+        count = min(len(images), self.memory_size - self.size)
+        start = self.size
+        if self.scales is not None:
+            q, offsets, scales = self._quantize(images[:count])
+            self.images[start:start + count] = q
+            self.offsets[start:start + count] = offsets
+            self.scales[start:start + count] = scales
+        else:
+            self.images[start:start + count] = images[:count]
+        self.labels[start:start + count] = label
+        if self.features is not None and features is not None:
+            self.features[start:start + count] = features[:count]
+        self.class_slices[label] = (start, count)
+        self.size += count
+        self.version += 1
+        return count
+
+    def state_dict(self):
+        return {
+            'class_slices': list(self.class_slices.items()),
+            'size': self.size,
+            'images': None if self.images is None else self.images[:self.size],
+            'image_dtype': None if self.image_dtype is None else self.image_dtype.str,
+            'offsets': None if self.offsets is None else self.offsets[:self.size],
+            'scales': None if self.scales is None else self.scales[:self.size],
+            'features': None if self.features is None else self.features[:self.size],
+            'labels': self.labels[:self.size],
+        }
+
+    def load_state_dict(self, state):
+        images, features = state['images'], state['features']
+        if images is not None:
+            quantized = state.get('scales') is not None
+            self._allocate(images.shape[1:], state.get('image_dtype') or images.dtype, quantized,
+                           None if features is None else features.shape[1])
+            self.images[:len(images)] = images
+            if quantized:
+                self.offsets[:len(images)] = state['offsets']
+                self.scales[:len(images)] = state['scales']
+            if features is not None:
+                self.features[:len(features)] = features
+        self.labels[:] = -1
+        self.labels[:len(state['labels'])] = state['labels']
+        self.class_slices = OrderedDict(state['class_slices'])
+        self.size = state['size']
+        self.version += 1
+
+    def get_class(self, label):
+        start, count = self.class_slices[label]
+        return self._read(slice(start, start + count))
+
+    def get_class_features(self, label):
+        start, count = self.class_slices[label]
+        return self.features[start:start + count]
+
+    def sample(self, batch_size, device=None):
+        """ Uniformly draw a replay batch as tensors on ``device``. """
+        index = np.random.randint(0, self.size, size=min(batch_size, self.size))
+        index.sort()  # monotone reads are friendlier to memory-mapped storage
+        x = torch.from_numpy(np.ascontiguousarray(self._read(index)))
+        y = torch.from_numpy(self.labels[index])
+        if device is not None:
+            x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+        return x, y
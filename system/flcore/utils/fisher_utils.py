@@ -0,0 +1,86 @@
+import hashlib
+import torch
+import torch.nn.functional as F
+from torch.autograd import grad
+
+
+def model_checksum(model):
+    """
+    Digest of the contents of a model's state (parameters and buffers). It also
+    sees writes through ``.data``, which most clients use to load weights and
+    which leave the autograd version counter unchanged.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for tensor in model.state_dict().values():
+        digest.update(tensor.detach().contiguous().view(-1).view(torch.uint8).cpu().numpy())
+    return digest.hexdigest()
+
+
+class FisherTraceEstimator():
+    """ Trace of the Fisher information matrix of a client model.
+
+    Modes:
+        exact: sum over mini-batches of the squared gradient norm of the batch NLL.
+        hutchinson: Rademacher probes v over the samples of a batch, with
+            E[||sum_i v_i g_i||^2] = sum_i ||g_i||^2 for the per-sample NLL
+            gradients g_i: the empirical Fisher trace, at the cost of one
+            backward pass per probe. Never negative, unlike Hessian probes.
+
+    At most ``max_batches`` mini-batches are visited (0 = all). A partial sum is
+    rescaled to the loader length, so values stay comparable with the full pass.
+    Results are cached per client and reused while the contents of its weights
+    are unchanged.
+    """
+    def __init__(self, mode='exact', max_batches=0, num_probes=1):
+        self.mode = mode
+        self.max_batches = max_batches
+        self.num_probes = num_probes
+        self.cache = {}  # cid -> (checksum, value)
+
+    def estimate(self, cid, model, loader, device):
+        checksum = model_checksum(model)
+        cached = self.cache.get(cid)
+        if cached is not None and cached[0] == checksum:
+            return cached[1]
+
+        value = self._estimate(model, loader, device)
+        self.cache[cid] = (checksum, value)
+        return value
+
+    def _estimate(self, model, loader, device):
+        params = [p for p in model.parameters() if p.requires_grad]
+        was_training = model.training
+        model.eval()
+
+        total = torch.zeros((), device=device)
+        used = 0
+        for i, (x, y) in enumerate(loader):
+            if self.max_batches > 0 and i >= self.max_batches:
+                break
+            if type(x) == type([]):
+                x[0] = x[0].to(device)
+            else:
+                x = x.to(device)
+            y = y.to(device)
+
+            if self.mode == 'hutchinson':
+                # per-sample negative log likelihoods, averaged like the batch loss
+                nll = F.nll_loss(F.log_softmax(model(x), dim=1), y, reduction='none') / y.size(0)
+                for k in range(self.num_probes):
+                    probes = torch.randint_like(nll, 2) * 2 - 1
+                    grads = grad((probes * nll).sum(), params, retain_graph=k < self.num_probes - 1)
+                    total += torch.stack([g.pow(2).sum() for g in grads]).sum().detach() / self.num_probes
+            else:
+                # Negative log likelihood as our loss
+                nll = F.nll_loss(F.log_softmax(model(x), dim=1), y)
+                grads = grad(nll, params)
+                total += torch.stack([g.pow(2).sum() for g in grads]).sum().detach()
+            used += 1
+
+        model.train(was_training)
+
+        if used == 0:
+            return 0.
+        if used < len(loader):
+            total = total * (len(loader) / used)
+        return total.item()
@@ -0,0 +1,95 @@
+import json
+import numpy as np
+
+
+class ClientProfile():
+    """ Compute and link characteristics of one simulated client.
+
+    Args:
+        compute_speed: Training throughput in samples per second.
+        up_bandwidth: Client -> server bandwidth in bytes per second.
+        down_bandwidth: Server -> client bandwidth in bytes per second.
+        latency: One-way latency in seconds, paid once per transfer.
+    """
+    def __init__(self, compute_speed=1000., up_bandwidth=1e6, down_bandwidth=1e7, latency=0.05):
+        self.compute_speed = compute_speed
+        self.up_bandwidth = up_bandwidth
+        self.down_bandwidth = down_bandwidth
+        self.latency = latency
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class NetworkSimulator():
+    """ Simulated wall clock for client compute and transfers, without sleeping.
+
+    Every client gets a ``ClientProfile``. Profiles are read from a JSON trace
+    file (a list of profile dicts, reused cyclically when shorter than the
+    number of clients, or a dict keyed by client id) or generated from the
+    defaults, with slow-training clients computing and slow-sending clients
+    transferring at a random 10%-50% of the default rate.
+
+    ``download_time``, ``compute_time`` and ``upload_time`` price the parts of a
+    client's round; ``trained_samples`` counts the samples a client processed
+    since it was last charged, and ``advance`` moves the global clock.
+    """
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.clock = 0.
+        self.samples_seen = {}  # cid -> cumulative samples at the previous round
+
+    @classmethod
+    def from_trace(cls, path, num_clients):
+        with open(path) as f:
+            trace = json.load(f)
+        if isinstance(trace, dict):
+            entries = [trace[str(cid)] for cid in range(num_clients)]
+        else:
+            entries = [trace[cid % len(trace)] for cid in range(num_clients)]
+        return cls([ClientProfile(**entry) for entry in entries])
+
+    @classmethod
+    def from_slow_clients(cls, train_slow_clients, send_slow_clients):
+        profiles = []
+        for train_slow, send_slow in zip(train_slow_clients, send_slow_clients):
+            profile = ClientProfile()
+            if train_slow:
+                profile.compute_speed *= np.random.uniform(0.1, 0.5)
+            if send_slow:
+                factor = np.random.uniform(0.1, 0.5)
+                profile.up_bandwidth *= factor
+                profile.down_bandwidth *= factor
+            profiles.append(profile)
+        return cls(profiles)
+
+    @classmethod
+    def from_args(cls, args, train_slow_clients, send_slow_clients):
+        if args.trace_file:
+            return cls.from_trace(args.trace_file, len(train_slow_clients))
+        return cls.from_slow_clients(train_slow_clients, send_slow_clients)
+
+    def profile(self, cid):
+        return self.profiles[cid % len(self.profiles)]
+
+    def compute_time(self, cid, num_samples):
+        return num_samples / self.profile(cid).compute_speed
+
+    def download_time(self, cid, nbytes):
+        profile = self.profile(cid)
+        return profile.latency + nbytes / profile.down_bandwidth
+
+    def upload_time(self, cid, nbytes):
+        profile = self.profile(cid)
+        return profile.latency + nbytes / profile.up_bandwidth
+
+    def trained_samples(self, client):
+        """ Samples the client processed since the previous call for it, which are now charged. """
+        total = client.train_time_cost['num_samples']
+        done = total - self.samples_seen.get(client.id, 0)
+        self.samples_seen[client.id] = total
+        return done
+
+    def advance(self, seconds):
+        self.clock += seconds
+        return self.clock
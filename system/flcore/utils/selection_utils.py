@@ -0,0 +1,105 @@
+import math
+import numpy as np
+
+
+class ClientSelector():
+    """ Uniform sampling without replacement, the default ``select_clients`` behaviour. """
+    name = 'uniform'
+
+    def select(self, server, num_clients):
+        return list(np.random.choice(server.clients, num_clients, replace=False))
+
+
+def expected_round_times(server, clients):
+    """
+    Expected simulated round time of each client. Clients with a history use
+    their recorded per-round costs: ``train_time_cost['sim_cost']`` (training and
+    upload) and ``send_time_cost['total_cost']`` (download). Without one, the
+    profile's time for a full local pass and full-model transfers is used.
+    """
+    simulator = server.simulator
+    model_bytes = sum(p.nelement() * p.element_size() for p in server.global_model.parameters())
+    times = []
+    for client in clients:
+        train, send = client.train_time_cost, client.send_time_cost
+        if train['num_rounds'] > 0 and train['sim_cost'] > 0:
+            train_upload = train['sim_cost'] / train['num_rounds']
+        else:
+            train_upload = simulator.compute_time(client.id, client.train_samples * client.local_epochs) + \
+                simulator.upload_time(client.id, model_bytes)
+        if send['num_rounds'] > 0:
+            download = send['total_cost'] / send['num_rounds']
+        else:
+            download = simulator.download_time(client.id, model_bytes)
+        times.append(train_upload + download)
+    return times
+
+
+class TimeAwareSelector(ClientSelector):
+    """
+    Samples clients with probability inversely proportional to their expected
+    round time (``expected_round_times``), so clients measured or profiled as
+    fast are preferred while slow ones are still visited.
+    """
+    name = 'time'
+
+    def select(self, server, num_clients):
+        inverse = 1. / (np.array(expected_round_times(server, server.clients)) + 1e-6)
+        return list(np.random.choice(server.clients, num_clients, replace=False, p=inverse / inverse.sum()))
+
+
+class PowerOfChoiceSelector(ClientSelector):
+    """
+    Power-of-choice: draws ``candidate_ratio * num_clients`` candidates in
+    proportion to their data size, then keeps those on which the current global
+    model has the highest loss (estimated on ``loss_batches`` batches).
+    """
+    name = 'poc'
+
+    def __init__(self, candidate_ratio=2., loss_batches=1):
+        self.candidate_ratio = candidate_ratio
+        self.loss_batches = loss_batches
+
+    def select(self, server, num_clients):
+        num_candidates = min(len(server.clients), max(num_clients, int(math.ceil(self.candidate_ratio * num_clients))))
+        sizes = np.array([client.train_samples for client in server.clients], dtype=np.float64)
+        candidates = np.random.choice(server.clients, num_candidates, replace=False, p=sizes / sizes.sum())
+
+        losses = [client.estimate_loss(server.global_model, self.loss_batches) for client in candidates]
+        order = np.argsort(losses)[::-1][:num_clients]
+        return [candidates[i] for i in order]
+
+
+class DeadlineSelector(ClientSelector):
+    """
+    Over-selects ``candidate_ratio * num_clients`` clients uniformly and keeps the
+    ``num_clients`` expected to finish first (``expected_round_times``).
+    """
+    name = 'deadline'
+
+    def __init__(self, candidate_ratio=1.5):
+        self.candidate_ratio = candidate_ratio
+
+    def select(self, server, num_clients):
+        num_candidates = min(len(server.clients), max(num_clients, int(math.ceil(self.candidate_ratio * num_clients))))
+        candidates = super().select(server, num_candidates)
+
+        finish = expected_round_times(server, candidates)
+        order = np.argsort(finish)[:num_clients]
+        return [candidates[i] for i in order]
+
+
+def make_selector(args):
+    strategy = args.select_strategy
+    if strategy == 'uniform' and args.time_select:
+        strategy = 'time'
+
+    if strategy == 'uniform':
+        return ClientSelector()
+    if strategy == 'time':
+        return TimeAwareSelector()
+    if strategy == 'poc':
+        return PowerOfChoiceSelector(candidate_ratio=args.select_candidate_ratio, loss_batches=args.poc_batches)
+    if strategy == 'deadline':
+        return DeadlineSelector(candidate_ratio=args.select_candidate_ratio)
+    raise NotImplementedError(strategy)
@@ -0,0 +1,97 @@
+import copy
+import torch
+from collections import OrderedDict
+
+
+class ModelSnapshots():
+    """ Versioned store of model weights kept as flat buffers.
+
+    The floating-point parameters and buffers of a version are packed into one
+    contiguous tensor and referenced by an integer version id. Every ``save``
+    copies the weights: tensor identity and ``_version`` cannot tell whether a
+    model changed, since ``.data`` writes do not bump ``_version`` and freed
+    storage is reused by later models. ``view`` materialises a version as a module whose
+    tensors are views into the flat buffer, so it adds no weight memory.
+
+    Args:
+        max_snapshots: Upper bound on the number of versions held; the oldest
+            versions are dropped first.
+    """
+    def __init__(self, max_snapshots=3):
+        self.max_snapshots = max_snapshots
+        self.snapshots = OrderedDict()  # version -> (flat, extras)
+        self.views = {}
+        self.next_version = 0
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __contains__(self, version):
+        return version in self.snapshots
+
+    def save(self, model):
+        state = model.state_dict()
+        flat = torch.cat([t.reshape(-1) for t in state.values() if t.is_floating_point()])
+        extras = {name: t.clone() for name, t in state.items() if not t.is_floating_point()}
+
+        version = self.next_version
+        self.next_version += 1
+        self.snapshots[version] = (flat, extras)
+
+        while len(self.snapshots) > self.max_snapshots:
+            self.release(next(iter(self.snapshots)))
+        return version
+
+    def release(self, version):
+        self.snapshots.pop(version, None)
+        self.views.pop(version, None)
+
+    def retain(self, versions):
+        """ Drop every version not listed in ``versions``. """
+        keep = set(v for v in versions if v is not None)
+        for version in list(self.snapshots.keys()):
+            if version not in keep:
+                self.release(version)
+
+    def state_dict(self):
+        return {'snapshots': self.snapshots, 'next_version': self.next_version}
+
+    def load_state_dict(self, state, device=None):
+        self.snapshots = OrderedDict(
+            (version, (flat.to(device), {name: t.to(device) for name, t in extras.items()}))
+            for version, (flat, extras) in state['snapshots'].items())
+        self.next_version = state['next_version']
+        self.views = {}
+
+    def load(self, version, model):
+        """ Copy a version into the tensors of ``model``. """
+        flat, extras = self.snapshots[version]
+        offset = 0
+        with torch.no_grad():
+            for name, t in model.state_dict(keep_vars=True).items():
+                if t.is_floating_point():
+                    t.data.copy_(flat[offset:offset + t.numel()].view_as(t))
+                    offset += t.numel()
+                else:
+                    t.data.copy_(extras[name])
+
+    def view(self, version, template):
+        """ A module shaped like ``template`` whose tensors alias the flat buffer of ``version``. """
+        if version is None:
+            return None
+        if version in self.views:
+            return self.views[version]
+
+        flat, extras = self.snapshots[version]
+        model = copy.deepcopy(template)
+        offset = 0
+        for name, t in model.state_dict(keep_vars=True).items():
+            if t.is_floating_point():
+                t.data = flat[offset:offset + t.numel()].view_as(t)
+                offset += t.numel()
+            else:
+                t.data = extras[name]
+        model.snapshot_version = version
+
+        self.views[version] = model
+        return model
@@ -1,41 +1,28 @@
 import os
 import sys
-import copy
-import torch
 import argparse
 import time
 import warnings
-import numpy as np
-import torchvision
 import logging
-import wandb
+from flcore.registry import ALGORITHMS, MODELS, DATASETS
 
-from flcore.servers.serveravg import FedAvg
-from flcore.servers.serverala import FedALA
-from flcore.servers.serverdbe import FedDBE
-from flcore.servers.serverstgm import FedSTGM
-from flcore.servers.serverfcil import FedFCIL
-
-from flcore.trainmodel.models import *
-
-from flcore.trainmodel.bilstm import *
-from flcore.trainmodel.resnet import *
-from flcore.trainmodel.alexnet import *
-from flcore.trainmodel.mobilenet_v2 import *
-from flcore.trainmodel.transformer import *
-
-from utils.result_utils import average_data
-from utils.mem_utils import MemReporter
+# torch, the servers and the models are imported inside run() (the registry
+# only names them), so that argument parsing (and --help) does not pay for them
 
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
 
 warnings.simplefilter("ignore")
-torch.manual_seed(0)
 
 
 def run(args):
+    import numpy as np
+    from flcore.registry import build_server
+    from utils.result_utils import average_data
+    from utils.mem_utils import MemReporter
+
     if args.wandb:
+        import wandb
         wandb.login(key="b1d6eed8871c7668a889ae74a621b5dbd2f3b070")
         wandb.init(
             project="FCL",
@@ -46,60 +33,19 @@ def run(args):
 
     time_list = []
     reporter = MemReporter()
-    model_str = args.model
 
     for i in range(args.prev, args.times):
         print(f"\n============= Running time: {i}th =============")
         print("Creating server and clients ...")
         start = time.time()
 
-        # Generate args.model
-        if model_str == "CNN": # non-convex
-            if "CIFAR100" in args.dataset:
-                args.model = FedAvgCNN(in_features=3, num_classes=args.num_classes, dim=1600).to(args.device)
-            elif "IMAGENET1k" in args.dataset:
-                args.model = FedAvgCNN(in_features=3, num_classes=args.num_classes, dim=1600).to(args.device)
-            else:
-                args.model = FedAvgCNN(in_features=3, num_classes=args.num_classes, dim=10816).to(args.device)
-
-        elif model_str == "ResNet18":
-            args.model = torchvision.models.resnet18(pretrained=False, num_classes=args.num_classes).to(args.device)
-        elif model_str == "ResNet10":
-            args.model = resnet10(num_classes=args.num_classes).to(args.device)
-        else:
-            raise NotImplementedError
-
-        print(args.model)
-
-        # select algorithm
-        if args.algorithm == "FedAvg":
-            args.head = copy.deepcopy(args.model.fc)
-            args.model.fc = nn.Identity()
-            args.model = BaseHeadSplit(args.model, args.head)
-            server = FedAvg(args, i)
-
-        elif args.algorithm == "FedALA":
-            server = FedALA(args, i)
-
-        elif args.algorithm == "FedDBE":
-            args.head = copy.deepcopy(args.model.fc)
-            args.model.fc = nn.Identity()
-            args.model = BaseHeadSplit(args.model, args.head)
-            server = FedDBE(args, i)
-        elif args.algorithm == "FedFCIL":
-            args.head = copy.deepcopy(args.model.fc)
-            args.model.fc = nn.Identity()
-            args.model = BaseHeadSplit(args.model, args.head)
-            server = FedFCIL(args, i)
-        elif args.algorithm == "FedSTGM":
-            args.head = copy.deepcopy(args.model.fc)
-            args.model.fc = nn.Identity()
-            args.model = BaseHeadSplit(args.model, args.head)
-            server = FedSTGM(args, i)
-        else:
-            raise NotImplementedError
+        # build args.model and the server of args.algorithm
+        server = build_server(args, i)
+
+        print(server.global_model)
 
         server.train()
+        server.save_results()
 
         time_list.append(time.time()-start)
 
@@ -110,9 +56,8 @@ def run(args):
     print("All done!")
     reporter.report()
 
-if __name__ == "__main__":
-    total_start = time.time()
 
+def get_parser():
     parser = argparse.ArgumentParser()
     # general
     parser.add_argument("--wandb", type=bool, default=False)
@@ -123,10 +68,9 @@ if __name__ == "__main__":
     parser.add_argument('-dev', "--device", type=str, default="cuda",
                         choices=["cpu", "cuda"])
     parser.add_argument('-did', "--device_id", type=str, default="0")
-    parser.add_argument('-data', "--dataset", type=str, default="CIFAR100", choices=['EMNIST-Letters', 'EMNIST-Letters-malicious', 
-                                                                            'EMNIST-Letters-shuffle', 'CIFAR100', 'MNIST-SVHN-FASHION', 'IMAGENET1k'])
+    parser.add_argument('-data', "--dataset", type=str, default="CIFAR100", choices=list(DATASETS))
     parser.add_argument('-ncl', "--num_classes", type=int, default=100)
-    parser.add_argument('-m', "--model", type=str, default="CNN")
+    parser.add_argument('-m', "--model", type=str, default="CNN", choices=list(MODELS))
     parser.add_argument('-lbs', "--batch_size", type=int, default=64)
     parser.add_argument('-lr', "--local_learning_rate", type=float, default=0.005,
                         help="Local learning rate")
@@ -137,7 +81,7 @@ if __name__ == "__main__":
                         help="For auto_break")
     parser.add_argument('-ls', "--local_epochs", type=int, default=1, 
                         help="Multiple update steps in one local epoch.")
-    parser.add_argument('-algo', "--algorithm", type=str, default="FedAvg")
+    parser.add_argument('-algo', "--algorithm", type=str, default="FedAvg", choices=list(ALGORITHMS))
     parser.add_argument('-jr', "--join_ratio", type=float, default=1.0,
                         help="Ratio of clients per round")
     parser.add_argument('-rjr', "--random_join_ratio", type=bool, default=False,
@@ -152,6 +96,8 @@ if __name__ == "__main__":
                         help="Rounds gap for evaluation")
     parser.add_argument('-sfn', "--save_folder_name", type=str, default='items')
     parser.add_argument('-ab', "--auto_break", type=bool, default=False)
+    parser.add_argument('-nw', "--num_workers", type=int, default=1,
+                        help="Clients processed concurrently by the server's client executor")
     parser.add_argument('-dlg', "--dlg_eval", type=bool, default=False)
     parser.add_argument('-dlgg', "--dlg_gap", type=int, default=100)
     parser.add_argument('-bnpc', "--batch_num_per_client", type=int, default=2)
@@ -164,6 +110,18 @@ if __name__ == "__main__":
 
     # Continual
     parser.add_argument('-mem', "--memory_size", type=int, default=2000)
+    parser.add_argument('-rbs', "--replay_batch_size", type=int, default=0,
+                        help="Exemplars mixed into every local batch, 0 disables rehearsal")
+    parser.add_argument('-emm', "--exemplar_mmap", type=bool, default=False,
+                        help="Memory-map the exemplar images under save_folder_name/<dataset>_<algorithm>_<goal>_<times>")
+    parser.add_argument('-eb', "--entropy_batches", type=int, default=0,
+                        help="Batches scored by the task-shift detector, 0 means all")
+    parser.add_argument('-epb', "--entropy_piggyback", type=bool, default=False,
+                        help="Reuse the previous round's first-epoch outputs (train mode, current-task rows) for the task-shift detector")
+    parser.add_argument('-dc', "--distill_cache", type=bool, default=False,
+                        help="Cache the old model's distillation targets per training sample")
+    parser.add_argument('-msn', "--max_snapshots", type=int, default=3,
+                        help="Upper bound on the global-model versions kept by the FCIL server, at least 3")
 
     # practical
     parser.add_argument('-cdr', "--client_drop_rate", type=float, default=0.0,
@@ -174,16 +132,69 @@ if __name__ == "__main__":
                         help="The rate for slow clients when sending global model")
     parser.add_argument('-ts', "--time_select", type=bool, default=False,
                         help="Whether to group and select clients at each round according to time cost")
+    parser.add_argument('-sst', "--select_strategy", type=str, default="uniform",
+                        choices=["uniform", "time", "poc", "deadline"],
+                        help="Client selection: uniform, time-aware, power-of-choice by loss, or deadline over-selection")
+    parser.add_argument('-scr', "--select_candidate_ratio", type=float, default=2.0,
+                        help="Candidates drawn per selected client by the poc and deadline strategies")
+    parser.add_argument('-pcb', "--poc_batches", type=int, default=1,
+                        help="Batches used to estimate each candidate's loss for power-of-choice")
     parser.add_argument('-tth', "--time_threthold", type=float, default=10000,
-                        help="The threthold for droping slow clients")
+                        help="The threthold (simulated seconds per round) for droping slow clients")
+    parser.add_argument('-asy', "--async_mode", type=bool, default=False,
+                        help="Buffered asynchronous aggregation (FedBuff) on the simulated clock")
+    parser.add_argument('-abs', "--async_buffer_size", type=int, default=10,
+                        help="Client updates aggregated per asynchronous round")
+    parser.add_argument('-ase', "--async_staleness_exp", type=float, default=0.5,
+                        help="Staleness weight (1 + staleness) ** -exp")
+    parser.add_argument('-trf', "--trace_file", type=str, default=None,
+                        help="JSON trace of client profiles (compute_speed, up_bandwidth, down_bandwidth, latency)")
+    # results
+    parser.add_argument('-mfl', "--metrics_flush", type=int, default=10,
+                        help="Values buffered per metric before appending to the results file, 0 writes it only at the end")
+    parser.add_argument('-hs', "--history_size", type=int, default=1000,
+                        help="Values of each metric kept in memory, 0 keeps all; ignored for saved metrics when metrics_flush is 0")
+
+    # checkpointing
+    parser.add_argument('-ckg', "--ckpt_gap", type=int, default=0,
+                        help="Checkpoint every ckpt_gap global rounds, 0 disables checkpoints; supported by "
+                             + ", ".join(name for name, algorithm in ALGORITHMS.items() if algorithm.checkpoint))
+    parser.add_argument('-ckd', "--ckpt_dir", type=str, default="checkpoints")
+    parser.add_argument('-res', "--resume", type=bool, default=False,
+                        help="Resume from the last checkpoint in ckpt_dir")
+
     # FedALA
     parser.add_argument('-et', "--eta", type=float, default=1.0)
     parser.add_argument('-s', "--rand_percent", type=int, default=80)
     parser.add_argument('-p', "--layer_idx", type=int, default=2,
                         help="More fine-grained than its original paper.")
+    # FedAS
+    parser.add_argument('-fime', "--fim_estimator", type=str, default="exact", choices=["exact", "hutchinson"],
+                        help="Estimator of the Fisher information trace")
+    parser.add_argument('-fimb', "--fim_batches", type=int, default=0,
+                        help="Mini-batches used per Fisher trace estimate, 0 means all")
+    parser.add_argument('-fimp', "--fim_probes", type=int, default=1,
+                        help="Rademacher probes per batch for the Hutchinson estimator")
     # FedDBE
     parser.add_argument('-mo', "--momentum", type=float, default=0.1)
     parser.add_argument('-klw', "--kl_weight", type=float, default=0.0)
+    parser.add_argument('-dwb', "--dbe_warmup_batches", type=int, default=0,
+                        help="Batches per client for the DBE global-mean warm-up, 0 means all")
+
+    # update compression
+    parser.add_argument('-ulc', "--uplink_codec", type=str, default="none",
+                        choices=["none", "identity", "topk", "q8", "q4", "lowrank"],
+                        help="Codec for client updates; none uploads client models by reference")
+    parser.add_argument('-tkr', "--topk_ratio", type=float, default=0.01,
+                        help="Fraction of entries kept by the topk codec")
+    parser.add_argument('-lrr', "--lowrank_rank", type=int, default=4,
+                        help="Rank of the lowrank codec factorisation")
+
+    parser.add_argument('-dlc', "--downlink_codec", type=str, default="none",
+                        choices=["none", "identity", "topk", "q8", "q4", "lowrank"],
+                        help="Codec for global-model deltas sent to clients; none sends the full model")
+    parser.add_argument('-dlh', "--downlink_history", type=int, default=5,
+                        help="Global versions kept for deltas; clients further behind get the full model")
 
     # FedSTGM
     parser.add_argument('-car', "--grad_stgm_rounds", type=int, default=100)
@@ -192,11 +203,31 @@ if __name__ == "__main__":
     parser.add_argument('-ss', "--step_size", type=int, default=30)
     parser.add_argument('-gam', "--gamma", type=float, default=0.5)
     parser.add_argument('-c', "--c_parameter", type=float, default=0.5)
+    parser.add_argument('-mn', "--memory_num", type=int, default=2000)
 
-    args = parser.parse_args()
+    return parser
+
+
+def make_args(**overrides):
+    """ Parser defaults with ``overrides`` applied, to build runs without a command line. """
+    args = get_parser().parse_args([])
+    for key, value in overrides.items():
+        if not hasattr(args, key):
+            raise ValueError("unknown option {}".format(key))
+        setattr(args, key, value)
+    return args
+
+
+if __name__ == "__main__":
+    total_start = time.time()
+
+    args = get_parser().parse_args()
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.device_id
 
+    import torch
+    torch.manual_seed(0)
+
     if args.device == "cuda" and not torch.cuda.is_available():
         print("\ncuda is not avaiable.\n")
         args.device = "cpu"
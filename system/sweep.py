@@ -0,0 +1,175 @@
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from main import make_args
+
+# A sweep is a JSON file:
+#     {
+#         "base": {"dataset": "CIFAR100", "global_rounds": 50, ...},
+#         "grid": {"algorithm": ["FedAvg", "FedAS"], "local_epochs": [1, 5]},
+#         "times": 3
+#     }
+# Every point of the grid (cartesian product) is run ``times`` times on top of
+# ``base`` and the parser defaults. Datasets are loaded once in this process
+# before the workers are forked, so every run reads the same copy-on-write shards.
+
+
+def expand(sweep):
+    """ (config index, overrides) for every point of the grid. """
+    grid = sweep.get('grid', {})
+    keys = list(grid)
+    configs = []
+    for k, values in enumerate(itertools.product(*[grid[key] for key in keys])):
+        overrides = dict(sweep.get('base', {}))
+        overrides.update(zip(keys, values))
+        # one results file (and checkpoint directory) per config and repetition
+        overrides['goal'] = "{}_cfg{}".format(overrides.get('goal', 'sweep'), k)
+        configs.append((k, overrides))
+    return configs
+
+
+def set_seed(seed):
+    import random
+    import numpy as np
+    import torch
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def run_one(job):
+    """ Train one config once; returns its summary row, with the error instead if it failed. """
+    k, overrides, times, seed, device_id = job
+    row = {'config': k, 'times': times, 'seed': seed}
+    row.update({key: overrides[key] for key in sorted(overrides)})
+
+    start = time.time()
+    try:
+        import torch
+        from flcore.registry import build_server
+
+        args = make_args(**overrides)
+        if args.device == "cuda" and not torch.cuda.is_available():
+            args.device = "cpu"
+        elif args.device == "cuda" and device_id is not None:
+            args.device = "cuda:{}".format(device_id)
+        set_seed(seed)
+
+        server = build_server(args, times)
+        # Client.__init__ seeds torch with 0 for every client; re-seed so that
+        # shuffling, dropout and stochastic codecs differ between runs
+        set_seed(seed)
+        server.train()
+        server.save_results()
+
+        row['best_acc'] = server.rs_test_acc.best
+        row['sim_time'] = server.simulator.clock
+        row['error'] = ''
+    except Exception:
+        row['best_acc'] = float('nan')
+        row['sim_time'] = float('nan')
+        row['error'] = traceback.format_exc().strip().splitlines()[-1]
+        traceback.print_exc()
+    row['wall_time'] = time.time() - start
+    return row
+
+
+def preload_datasets(configs):
+    """ Load every dataset the sweep uses into this process's cache before forking. """
+    from flcore.registry import dataset_key, load_dataset
+    seen = set()
+    for _, overrides in configs:
+        args = make_args(**overrides)
+        if dataset_key(args) not in seen:
+            seen.add(dataset_key(args))
+            print("Loading {} ...".format(args.dataset))
+            load_dataset(args)
+
+
+def summarize(rows):
+    """ Mean and std of the best accuracy over the repetitions of every config. """
+    import numpy as np
+    table = []
+    for k, group in itertools.groupby(sorted(rows, key=lambda r: r['config']), key=lambda r: r['config']):
+        group = list(group)
+        accs = [r['best_acc'] for r in group if not r['error']]
+        table.append({
+            'config': k,
+            'algorithm': group[0].get('algorithm', ''),
+            'runs': len(accs),
+            'failed': len(group) - len(accs),
+            'mean_acc': float(np.mean(accs)) if accs else float('nan'),
+            'std_acc': float(np.std(accs)) if accs else float('nan'),
+            'wall_time': float(np.mean([r['wall_time'] for r in group])),
+        })
+    return table
+
+
+def print_table(table):
+    columns = ['config', 'algorithm', 'runs', 'failed', 'mean_acc', 'std_acc', 'wall_time']
+    print(''.join("{:>12}".format(c) for c in columns))
+    for row in table:
+        print(''.join("{:>12.4f}".format(row[c]) if isinstance(row[c], float) else "{:>12}".format(row[c])
+                      for c in columns))
+
+
+def write_csv(rows, path):
+    result_path = os.path.dirname(path)
+    if result_path and not os.path.exists(result_path):
+        os.makedirs(result_path)
+    fields = []
+    for row in rows:
+        fields += [key for key in row if key not in fields]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-sw', "--sweep", type=str, required=True,
+                        help="JSON file with base, grid and times")
+    parser.add_argument('-w', "--workers", type=int, default=1,
+                        help="Runs trained concurrently in forked processes, 1 trains them in this process")
+    parser.add_argument('-sd', "--seed", type=int, default=0,
+                        help="Seed of the first run; run i uses seed + i")
+    parser.add_argument('-dids', "--device_ids", type=str, default=None,
+                        help="Comma-separated GPU ids (as seen under CUDA_VISIBLE_DEVICES) assigned to runs round-robin")
+    parser.add_argument('-o', "--output", type=str, default="../results/sweep.csv")
+    sweep_args = parser.parse_args()
+
+    with open(sweep_args.sweep) as f:
+        sweep = json.load(f)
+    configs = expand(sweep)
+    device_ids = sweep_args.device_ids.split(',') if sweep_args.device_ids else [None]
+
+    jobs = []
+    for k, overrides in configs:
+        for i in range(sweep.get('times', 1)):
+            n = len(jobs)
+            jobs.append((k, overrides, i, sweep_args.seed + n, device_ids[n % len(device_ids)]))
+    print("{} configs, {} runs".format(len(configs), len(jobs)))
+
+    total_start = time.time()
+    preload_datasets(configs)
+    if sweep_args.workers > 1:
+        # fork keeps the loaded datasets shared with the workers; CUDA is not
+        # initialised in this process, so the children can still use it
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=sweep_args.workers, mp_context=context) as executor:
+            rows = list(executor.map(run_one, jobs))
+    else:
+        rows = [run_one(job) for job in jobs]
+
+    write_csv(rows, sweep_args.output)
+    print("\nSummary ({} runs in {:.1f}s), per-run results in {}".format(
+        len(rows), time.time() - total_start, sweep_args.output))
+    print_table(summarize(rows))
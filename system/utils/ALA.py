@@ -20,9 +20,27 @@ import torch
 import torch.nn as nn
 import copy
 import random
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SubsetRandomSampler
 from typing import List, Tuple
 
+
+def _foreach_copy_(dst: List[torch.Tensor], src: List[torch.Tensor]) -> None:
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
+
+
+def _foreach_clamp_(tensors: List[torch.Tensor], min: float, max: float) -> None:
+    if hasattr(torch, '_foreach_clamp_min_'):
+        torch._foreach_clamp_min_(tensors, min)
+        torch._foreach_clamp_max_(tensors, max)
+    else:
+        for t in tensors:
+            t.clamp_(min, max)
+
+
 class ALA:
     def __init__(self,
                 cid: int,
@@ -56,7 +74,6 @@ class ALA:
 
         self.cid = cid
         self.loss = loss
-        self.train_data = train_data
         self.batch_size = batch_size
         self.rand_percent = rand_percent
         self.layer_idx = layer_idx
@@ -67,29 +84,58 @@ class ALA:
 
         self.weights = None # Learnable local aggregation weights.
         self.start_phase = True
+        self.model_t = None # Persistent temp local model for weight learning.
+        self.generator = torch.Generator() # Sampling RNG of seeded calls.
+
+        self.set_train_data(train_data)
+
+
+    def set_train_data(self, train_data: List[Tuple]) -> None:
+        """
+        Pre-indexes a random permutation of the local training data and builds
+        a persistent DataLoader whose sampler is re-pointed at a new window of
+        that permutation on every call.
+
+        Args:
+            train_data: The reference of the local training data.
+
+        Returns:
+            None.
+        """
+        self.train_data = train_data
+        self.rand_num = int(self.rand_percent / 100 * len(train_data))
+        self.perm = torch.randperm(len(train_data))
+        self.rand_sampler = SubsetRandomSampler(self.perm[:self.rand_num].tolist())
+        self.rand_loader = DataLoader(train_data, self.batch_size, sampler=self.rand_sampler, drop_last=False)
 
 
     def adaptive_local_aggregation(self, 
                             global_model: nn.Module,
-                            local_model: nn.Module) -> None:
+                            local_model: nn.Module,
+                            seed: int = None) -> None:
         """
-        Generates the Dataloader for the randomly sampled local training data and 
+        Samples a random window of the pre-indexed local training data and 
         preserves the lower layers of the update. 
 
         Args:
             global_model: The received global/aggregated model. 
             local_model: The trained local model. 
+            seed: Seeds the window and its shuffling, so that clients running concurrently
+                do not depend on the thread schedule. Default: None (global RNGs)
 
         Returns:
             None.
         """
 
         # randomly sample partial local training data
-        rand_ratio = self.rand_percent / 100
-        rand_num = int(rand_ratio*len(self.train_data))
-        rand_idx = random.randint(0, len(self.train_data)-rand_num)
-        rand_loader = DataLoader(self.train_data[rand_idx:rand_idx+rand_num], self.batch_size, drop_last=False)
-
+        if seed is None:
+            rand_idx = random.randint(0, len(self.train_data) - self.rand_num)
+            self.rand_sampler.generator = None
+        else:
+            rand_idx = random.Random(seed).randint(0, len(self.train_data) - self.rand_num)
+            self.generator.manual_seed(seed)
+            self.rand_sampler.generator = self.generator
+        self.rand_sampler.indices = self.perm[rand_idx:rand_idx + self.rand_num].tolist()
 
         # obtain the references of the parameters
         params_g = list(global_model.parameters())
@@ -100,61 +146,62 @@ class ALA:
             return
 
         # preserve all the updates in the lower layers
-        for param, param_g in zip(params[:-self.layer_idx], params_g[:-self.layer_idx]):
-            param.data = param_g.data.clone()
-
-
-        # temp local model only for weight learning
-        model_t = copy.deepcopy(local_model)
-        params_t = list(model_t.parameters())
+        with torch.no_grad():
+            _foreach_copy_([p.data for p in params[:-self.layer_idx]], [p.data for p in params_g[:-self.layer_idx]])
+
+        # temp local model only for weight learning, built once and reused
+        if self.model_t is None:
+            self.model_t = copy.deepcopy(local_model)
+            # frozen the lower layers to reduce computational cost in Pytorch
+            for param in list(self.model_t.parameters())[:-self.layer_idx]:
+                param.requires_grad = False
+        params_t = list(self.model_t.parameters())
+
+        # the frozen lower layers alias the local model, only the higher layers are materialized
+        for param_t, param in zip(params_t[:-self.layer_idx], params[:-self.layer_idx]):
+            param_t.data = param.data
+        with torch.no_grad():
+            for buf_t, buf in zip(self.model_t.buffers(), local_model.buffers()):
+                buf_t.copy_(buf)
 
         # only consider higher layers
-        params_p = params[-self.layer_idx:]
-        params_gp = params_g[-self.layer_idx:]
+        params_p = [p.data for p in params[-self.layer_idx:]]
+        params_gp = [p.data for p in params_g[-self.layer_idx:]]
         params_tp = params_t[-self.layer_idx:]
-
-        # frozen the lower layers to reduce computational cost in Pytorch
-        for param in params_t[:-self.layer_idx]:
-            param.requires_grad = False
-
-        # used to obtain the gradient of higher layers
-        # no need to use optimizer.step(), so lr=0
-        optimizer = torch.optim.SGD(params_tp, lr=0)
+        data_tp = [p.data for p in params_tp]
 
         # initialize the weight to all ones in the beginning
         if self.weights == None:
-            self.weights = [torch.ones_like(param.data).to(self.device) for param in params_p]
+            self.weights = [torch.ones_like(param).to(self.device) for param in params_p]
+
+        # the update direction is fixed during weight learning
+        diffs = torch._foreach_sub(params_gp, params_p)
 
         # initialize the higher layers in the temp local model
-        for param_t, param, param_g, weight in zip(params_tp, params_p, params_gp,
-                                                self.weights):
-            param_t.data = param + (param_g - param) * weight
+        with torch.no_grad():
+            _foreach_copy_(data_tp, torch._foreach_addcmul(params_p, diffs, self.weights))
 
         # weight learning
         losses = []  # record losses
         cnt = 0  # weight training iteration counter
         while True:
-            for x, y in rand_loader:
+            for x, y in self.rand_loader:
                 if type(x) == type([]):
                     x[0] = x[0].to(self.device)
                 else:
                     x = x.to(self.device)
                 y = y.to(self.device)
-                optimizer.zero_grad()
-                output = model_t(x)
+                output = self.model_t(x)
                 loss_value = self.loss(output, y) # modify according to the local objective
-                loss_value.backward()
+                grads = torch.autograd.grad(loss_value, params_tp)
 
-                # update weight in this batch
-                for param_t, param, param_g, weight in zip(params_tp, params_p,
-                                                        params_gp, self.weights):
-                    weight.data = torch.clamp(
-                        weight - self.eta * (param_t.grad * (param_g - param)), 0, 1)
+                with torch.no_grad():
+                    # update weight in this batch
+                    torch._foreach_addcmul_(self.weights, grads, diffs, value=-self.eta)
+                    _foreach_clamp_(self.weights, 0, 1)
 
-                # update temp local model in this batch
-                for param_t, param, param_g, weight in zip(params_tp, params_p,
-                                                        params_gp, self.weights):
-                    param_t.data = param + (param_g - param) * weight
+                    # update temp local model in this batch
+                    _foreach_copy_(data_tp, torch._foreach_addcmul(params_p, diffs, self.weights))
 
             losses.append(loss_value.item())
             cnt += 1
@@ -172,5 +219,5 @@ class ALA:
         self.start_phase = False
 
         # obtain initialized local model
-        for param, param_t in zip(params_p, params_tp):
-            param.data = param_t.data.clone()
\ No newline at end of file
+        with torch.no_grad():
+            _foreach_copy_(params_p, data_tp)
@@ -0,0 +1,130 @@
+# PFLlib: Personalized Federated Learning Algorithm Library
+# Copyright (C) 2021  Jianqing Zhang
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import torch
+import torch.nn as nn
+from typing import Optional, Tuple
+
+
+class DBE(nn.Module):
+    def __init__(self,
+                feature_shape: Tuple[int, ...],
+                momentum: float = 0.1,
+                kl_weight: float = 0.0) -> None:
+        """
+        Initialize the client-side DBE (domain bias eliminator) state
+
+        Args:
+            feature_shape: Shape of one representation produced by the model base.
+            momentum: Momentum of the running mean of the representations. Default: 0.1
+            kl_weight: Weight of the regularization towards the global mean. Default: 0.0
+
+        Returns:
+            None.
+        """
+        super().__init__()
+        self.momentum = momentum
+        self.kl_weight = kl_weight
+
+        self.register_buffer('running_mean', torch.zeros(feature_shape))
+        self.register_buffer('num_batches_tracked', torch.tensor(0, dtype=torch.long))
+        self.register_buffer('global_mean', None)
+        self.client_mean = nn.Parameter(torch.zeros(feature_shape))
+
+    @staticmethod
+    def feature_shape(model: nn.Module) -> Tuple[int, ...]:
+        """
+        Reads the representation shape from the first linear layer of the head,
+        so no forward pass over the data is needed.
+
+        Args:
+            model: A model split into base and head.
+
+        Returns:
+            The shape of one representation.
+        """
+        for module in model.head.modules():
+            if isinstance(module, nn.Linear):
+                return (module.in_features,)
+        raise ValueError("cannot infer the representation shape from the model head")
+
+    def reset_running_stats(self) -> None:
+        self.running_mean.zero_()
+        self.num_batches_tracked.zero_()
+
+    def update_running_mean(self, rep: torch.Tensor) -> torch.Tensor:
+        """
+        Moves the running mean towards the batch mean of ``rep``; the returned
+        value keeps the graph of the current batch, the stored buffer does not.
+
+        Args:
+            rep: A batch of representations.
+
+        Returns:
+            The updated running mean.
+        """
+        self.num_batches_tracked.add_(1)
+        running_mean = torch.lerp(self.running_mean, rep.mean(dim=0), self.momentum)
+        self.running_mean.copy_(running_mean.detach())
+        return running_mean
+
+    @torch.no_grad()
+    def collect_running_mean(self,
+                            base: nn.Module,
+                            loader,
+                            device: str,
+                            max_batches: int = 0) -> None:
+        """
+        Warm-up statistics only: runs the base over the local data without
+        gradients and accumulates the running mean as training would.
+
+        Args:
+            base: The feature extractor of the model.
+            loader: The local training data.
+            device: Using cuda or cpu.
+            max_batches: Number of batches to use, 0 means all. Default: 0
+
+        Returns:
+            None.
+        """
+        self.reset_running_stats()
+        for i, (x, y) in enumerate(loader):
+            if max_batches > 0 and i >= max_batches:
+                break
+            if type(x) == type([]):
+                x[0] = x[0].to(device)
+            else:
+                x = x.to(device)
+            self.update_running_mean(base(x))
+
+    def forward(self, rep: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Updates the running mean and debiases the representations.
+
+        Args:
+            rep: A batch of representations.
+
+        Returns:
+            The representations for the head and the weighted regularization
+            loss, which is None before the global mean is known.
+        """
+        running_mean = self.update_running_mean(rep)
+        if self.global_mean is None:
+            return rep, None
+
+        reg_loss = torch.mean(0.5 * (running_mean - self.global_mean) ** 2)
+        return rep + self.client_mean, reg_loss * self.kl_weight
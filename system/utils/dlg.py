@@ -16,7 +16,6 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 # -*- coding: utf-8 -*-
-import matplotlib.pyplot as plt
 import torch
 import torch.nn.functional as F
 import numpy as np
@@ -23,10 +23,18 @@ from typing import Optional, Tuple, List
 import torch
   
 from math import isnan
-from calmsize import size as calmsize
 
 def readable_size(num_bytes: int) -> str:
-    return '' if isnan(num_bytes) else '{:.2f}'.format(calmsize(num_bytes))
+    if isnan(num_bytes):
+        return ''
+    try:
+        from calmsize import size as calmsize
+    except ImportError:  # optional dependency
+        for unit in ['B', 'K', 'M', 'G']:
+            if abs(num_bytes) < 1024 or unit == 'G':
+                return '{:.2f}{}'.format(num_bytes, unit)
+            num_bytes /= 1024
+    return '{:.2f}'.format(calmsize(num_bytes))
 
 LEN = 79
 
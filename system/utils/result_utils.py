@@ -15,17 +15,15 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import h5py
 import numpy as np
 import os
 
 
 def average_data(algorithm="", dataset="", goal="", times=10):
-    test_acc = get_all_results_for_one_algo(algorithm, dataset, goal, times)
-
     max_accurancy = []
     for i in range(times):
-        max_accurancy.append(test_acc[i].max())
+        file_name = dataset + "_" + algorithm + "_" + goal + "_" + str(i)
+        max_accurancy.append(read_best(file_name))
 
     print("std for best accurancy:", np.std(max_accurancy))
     print("mean for best accurancy:", np.mean(max_accurancy))
@@ -42,6 +40,7 @@ def get_all_results_for_one_algo(algorithm="", dataset="", goal="", times=10):
 
 
 def read_data_then_delete(file_name, delete=False):
+    import h5py
     file_path = "../results/" + file_name + ".h5"
 
     with h5py.File(file_path, 'r') as hf:
@@ -51,4 +50,139 @@ def read_data_then_delete(file_name, delete=False):
         os.remove(file_path)
     print("Length: ", len(rs_test_acc))
 
-    return rs_test_acc
\ No newline at end of file
+    return rs_test_acc
+
+
+def read_best(file_name, key='rs_test_acc', chunk_size=65536):
+    """ Maximum of one metric, read chunk by chunk instead of loading the whole dataset. """
+    import h5py
+    file_path = "../results/" + file_name + ".h5"
+
+    best = -np.inf
+    with h5py.File(file_path, 'r') as hf:
+        dataset = hf[key]
+        for start in range(0, dataset.shape[0], chunk_size):
+            best = max(best, float(np.max(dataset[start:start + chunk_size])))
+        print("Length: ", dataset.shape[0])
+
+    return best
+
+
+class MetricsWriter():
+    """ Append-only h5 sink for metrics.
+
+    Every metric is a chunked, resizable 1-D dataset. Values are buffered per
+    metric and appended to the file every ``flush_every`` values, so a run
+    never holds its full history in memory and a crash loses at most one
+    buffer. Per-client metrics are stored in long format (one row per client
+    and evaluation) so the number of clients may vary. ``close`` releases the
+    file so it can be read back; a later write reopens it.
+    """
+    def __init__(self, file_path, flush_every=10, chunk_size=1024, resume=False):
+        result_path = os.path.dirname(file_path)
+        if result_path and not os.path.exists(result_path):
+            os.makedirs(result_path)
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.chunk_size = chunk_size
+        import h5py
+        self.hf = h5py.File(file_path, 'a' if resume else 'w')
+        self.pending = {}  # name -> values not written yet
+
+    def _file(self):
+        if self.hf is None:
+            import h5py
+            self.hf = h5py.File(self.file_path, 'a')
+        return self.hf
+
+    def append(self, name, value):
+        self.extend(name, [value])
+
+    def extend(self, name, values):
+        pending = self.pending.setdefault(name, [])
+        pending.extend(values)
+        if len(pending) >= self.flush_every:
+            self._write(name)
+            self.hf.flush()
+
+    def _write(self, name):
+        values = np.asarray(self.pending.pop(name, []))
+        if len(values) == 0:
+            return
+        hf = self._file()
+        if name not in hf:
+            hf.create_dataset(name, shape=(0,), maxshape=(None,), chunks=(self.chunk_size,), dtype=values.dtype)
+        dataset = hf[name]
+        length = dataset.shape[0]
+        dataset.resize((length + len(values),))
+        dataset[length:] = values
+
+    def flush(self):
+        for name in list(self.pending.keys()):
+            self._write(name)
+        self._file().flush()
+
+    def lengths(self):
+        """ Number of values appended so far per metric, written or pending. """
+        hf = self._file()
+        lengths = {name: hf[name].shape[0] for name in hf.keys()}
+        for name, values in self.pending.items():
+            lengths[name] = lengths.get(name, 0) + len(values)
+        return lengths
+
+    def truncate(self, lengths):
+        """ Drop everything appended after ``lengths`` was taken, e.g. when resuming a run. """
+        self.flush()
+        for name in list(self.hf.keys()):
+            length = lengths.get(name, 0)
+            if self.hf[name].shape[0] > length:
+                self.hf[name].resize((length,))
+        self.hf.flush()
+
+    def close(self):
+        if self.hf is None:
+            return
+        self.flush()
+        self.hf.close()
+        self.hf = None
+
+
+class MetricHistory(list):
+    """ Metric history keeping only the last ``maxlen`` values in memory (0 keeps all).
+
+    ``count``, ``best`` and ``best_index`` (position of ``best`` among all values)
+    cover every value ever appended; ``mode`` is 'max',
+    'min' or None for values without an order. Appended values are also
+    streamed to ``writer`` under ``name`` when one is given.
+    """
+    def __init__(self, name, maxlen=0, writer=None, mode='max'):
+        super().__init__()
+        self.name = name
+        self.maxlen = maxlen
+        self.writer = writer
+        self.mode = mode
+        self.count = 0
+        self.best = None
+        self.best_index = None
+
+    def append(self, value):
+        super().append(value)
+        if (self.mode == 'max' and (self.best is None or value > self.best)) or \
+                (self.mode == 'min' and (self.best is None or value < self.best)):
+            self.best = value
+            self.best_index = self.count
+        self.count += 1
+        if self.writer is not None:
+            self.writer.append(self.name, value)
+        if self.maxlen > 0 and len(self) > self.maxlen:
+            del self[:len(self) - self.maxlen]
+
+    def state_dict(self):
+        return {'values': list(self), 'count': self.count, 'best': self.best, 'best_index': self.best_index}
+
+    def load_state_dict(self, state):
+        self.clear()
+        self.extend(state['values'])
+        self.count = state['count']
+        self.best = state['best']
+        self.best_index = state.get('best_index')
\ No newline at end of file